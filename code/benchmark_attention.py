@@ -0,0 +1,109 @@
+import time
+import resource
+import argparse
+import multiprocessing
+import torch
+from models import Attention
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Compare the full and the tiled label attention')
+    parser.add_argument('--batch_size', type=int, default=8)
+    parser.add_argument('--seq_len', type=int, default=2500)
+    parser.add_argument('--num_labels', type=int, default=50)
+    parser.add_argument('--embed_size', type=int, default=128)
+    parser.add_argument('--label_attn_expansion', type=int, default=2)
+    parser.add_argument('--attn_tile_size', type=int, default=256)
+    parser.add_argument('--repeats', type=int, default=3)
+    return parser.parse_args()
+
+
+def make_inputs(args, device):
+    torch.manual_seed(0)
+    hidden = torch.randn(args.batch_size, args.seq_len, args.embed_size, device=device, requires_grad=True)
+    lengths = torch.randint(args.seq_len // 2, args.seq_len + 1, (args.batch_size,), device=device)
+    attn_mask = (torch.arange(args.seq_len, device=device).unsqueeze(0) < lengths.unsqueeze(1)).unsqueeze(2)
+    return hidden, attn_mask
+
+
+def make_attention(args, tile_size, device):
+    torch.manual_seed(1)
+    return Attention(args.embed_size, args.num_labels, args.label_attn_expansion, 0.0, tile_size).to(device)
+
+
+def check_outputs(args, device):
+    """Max abs difference of the tiled outputs, input gradients and parameter gradients from the full attention"""
+    hidden, attn_mask = make_inputs(args, device)
+    diffs = {}
+    results = []
+    for tile_size in [None, args.attn_tile_size]:
+        attn = make_attention(args, tile_size, device)
+        hidden.grad = None
+        output, _ = attn(hidden, attn_mask)
+        output.sum().backward()
+        results.append((output.detach(), hidden.grad.clone(), [p.grad.clone() for p in attn.parameters()]))
+    (full_out, full_grad, full_params), (tiled_out, tiled_grad, tiled_params) = results
+    diffs['output'] = (full_out - tiled_out).abs().max().item()
+    diffs['input grad'] = (full_grad - tiled_grad).abs().max().item()
+    diffs['param grad'] = max((a - b).abs().max().item() for a, b in zip(full_params, tiled_params))
+
+    # The label subset path against rows of the full attention weights
+    attn = make_attention(args, args.attn_tile_size, device)
+    full_attn = make_attention(args, None, device)
+    with torch.no_grad():
+        _, full_weights = full_attn(hidden, attn_mask)
+        labels = torch.randint(0, args.num_labels, (args.batch_size, 5), device=device)
+        subset = attn.label_weights(hidden, attn_mask, labels)
+        expected = full_weights.gather(1, labels.unsqueeze(2).expand(-1, -1, args.seq_len))
+    diffs['label weights'] = (subset - expected).abs().max().item()
+    return diffs
+
+
+def time_attention(args, tile_size, device, queue=None):
+    """Average forward + backward seconds and peak memory (MB) of one attention variant"""
+    hidden, attn_mask = make_inputs(args, device)
+    attn = make_attention(args, tile_size, device)
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+    start_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start_time = time.time()
+    for _ in range(args.repeats):
+        output, _ = attn(hidden, attn_mask)
+        output.sum().backward()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+        peak_mb = torch.cuda.max_memory_allocated() / 2 ** 20
+    else:
+        # ru_maxrss is in KB on Linux, measured in a fresh process per variant
+        peak_mb = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - start_rss) / 2 ** 10
+    result = ((time.time() - start_time) / args.repeats, peak_mb)
+    if queue is not None:
+        queue.put(result)
+    return result
+
+
+def run_variant(args, tile_size, device):
+    if device.type == 'cuda':
+        return time_attention(args, tile_size, device)
+    # Peak RSS never goes down, so every CPU variant runs in its own process
+    ctx = multiprocessing.get_context('fork')
+    queue = ctx.Queue()
+    process = ctx.Process(target=time_attention, args=(args, tile_size, device, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+if __name__ == "__main__":
+    args = get_args()
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    print(f"B={args.batch_size} S={args.seq_len} L={args.num_labels} H={args.embed_size} "
+          f"expansion={args.label_attn_expansion} on {device}")
+    for name, diff in check_outputs(args, device).items():
+        print(f"  max abs diff, {name}: {diff:.2e}")
+    full_time, full_mb = run_variant(args, None, device)
+    tiled_time, tiled_mb = run_variant(args, args.attn_tile_size, device)
+    print(f"  full:            {full_time * 1000:.1f} ms/iter, peak {full_mb:.1f} MB")
+    print(f"  tiled ({args.attn_tile_size:>4}):    {tiled_time * 1000:.1f} ms/iter, peak {tiled_mb:.1f} MB")
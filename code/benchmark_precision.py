@@ -0,0 +1,65 @@
+import time
+import logging
+import torch
+import torch.optim as optim
+import constants
+from models import build_model
+from data import prepare_datasets, load_embedding_weights
+from trainer import make_loader, resolve_amp_dtype, train_epoch, evaluate, compute_scores
+from checkpoint import set_seed
+from run_manager import RunManager
+from main import get_hyper_params_combinations
+
+
+def run_precision(args, device, datasets, embed_weights, hyper_params, mixed_precision):
+    """Train from args.random_seed with or without autocast and return (examples/sec, dev scores)"""
+    train_set, dev_set, train_label_freq = datasets
+    set_seed(args.random_seed, device.type == 'cuda')
+    model = build_model(args, embed_weights, train_set.get_code_count(), device, train_label_freq).to(device)
+    optimizer = optim.AdamW(model.parameters(), lr=hyper_params.learning_rate)
+    amp_dtype = resolve_amp_dtype(device, mixed_precision)
+    train_loader = make_loader(train_set, args.batch_size, shuffle=True, bucket_batching=args.bucket_batching,
+                               max_tokens=args.max_tokens)
+
+    m = RunManager()
+    m.begin_run(hyper_params, model, train_loader)
+    train_time = 0
+    for epoch in range(hyper_params.num_epoch):
+        m.begin_epoch(epoch + 1)
+        start_time = time.time()
+        train_epoch(model, train_loader, optimizer, device, m, amp_dtype,
+                    accumulation_steps=args.accumulation_steps)
+        train_time += time.time() - start_time
+        m.end_epoch()
+    m.end_run()
+
+    dev_loader = make_loader(dev_set, args.batch_size, shuffle=False, bucket_batching=args.bucket_batching,
+                             max_tokens=args.max_tokens)
+    probabs, targets, _, _ = evaluate(model, dev_loader, device, dtset='dev', amp_dtype=amp_dtype)
+    scores = compute_scores(probabs, targets, hyper_params, dtset='dev')
+    return len(train_set) * hyper_params.num_epoch / train_time, scores
+
+
+if __name__ == "__main__":
+    args = constants.get_args()
+    FORMAT = '%(asctime)-15s %(message)s'
+    logging.basicConfig(format=FORMAT, level=getattr(logging, args.log.upper()))
+    use_cuda = torch.cuda.is_available()
+    device = torch.device("cuda" if use_cuda else "cpu")
+
+    train_set, dev_set, _, _, train_label_freq, _ = prepare_datasets(args.data_setting, args.max_len,
+                                                                     dynamic_padding=args.bucket_batching)
+    embed_weights = load_embedding_weights()
+    hyper_params = get_hyper_params_combinations(args)[0]
+
+    fp32_speed, fp32_scores = run_precision(args, device, (train_set, dev_set, train_label_freq), embed_weights,
+                                            hyper_params, mixed_precision=False)
+    amp_speed, amp_scores = run_precision(args, device, (train_set, dev_set, train_label_freq), embed_weights,
+                                          hyper_params, mixed_precision=True)
+
+    print(f"\nTraining throughput with {hyper_params} (seed {args.random_seed}) on {device}:")
+    print(f"  fp32:            {fp32_speed:.2f} examples/sec")
+    print(f"  mixed precision: {amp_speed:.2f} examples/sec ({amp_speed / fp32_speed:.2f}x)")
+    print("\nDev metric difference (mixed precision - fp32):")
+    for name, value in fp32_scores.items():
+        print(f"  {name}: {amp_scores[name] - value:+.4f} ({value:.4f} -> {amp_scores[name]:.4f})")
@@ -0,0 +1,128 @@
+import os
+import random
+import logging
+import argparse
+import numpy as np
+import torch
+from models import build_model
+
+# Command line arguments needed to rebuild a model with build_model
+MODEL_ARGS = ['model', 'data_setting', 'embed_size', 'freeze_embed', 'max_len', 'chunk_size', 'num_trans_layers',
+              'num_attn_heads', 'trans_forward_expansion', 'label_attn_expansion', 'attn_tile_size', 'dropout_rate']
+# Version 2: PositionalEncoding encodes token positions. Version 1 bundles (no format_version) were trained
+# with it adding the encoding of each note's index in the batch, so their weights expect different inputs
+MODEL_FORMAT_VERSION = 2
+# Arguments a training checkpoint must agree on to be resumed. num_epoch may differ, to extend a schedule
+TRAIN_ARGS = MODEL_ARGS + ['batch_size', 'accumulation_steps', 'bucket_batching', 'max_tokens', 'mixed_precision',
+                           'early_stopping_metric', 'monitor_steps']
+
+
+def save_model(path, model, args, labels):
+    """
+    Save a trained model as a self-describing bundle: the format version, the arguments it was built from,
+    its label list (in output column order) and its weights, so it can be reloaded without the training data.
+    """
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    torch.save({'format_version': MODEL_FORMAT_VERSION,
+                'model_args': {name: getattr(args, name) for name in MODEL_ARGS},
+                'labels': list(labels),
+                'state_dict': model.state_dict()}, path)
+    logging.info(f'Saved model to {path}')
+
+
+def load_model(path, device, allow_old_format=False):
+    """
+    Raises ValueError for bundles saved before MODEL_FORMAT_VERSION, whose weights were trained with the old
+    positional encoding, unless allow_old_format is set (they are then loaded as is, with a warning).
+    :return: Returns (model in eval mode on device, labels, model args namespace)
+    """
+    bundle = torch.load(path, map_location='cpu')
+    format_version = bundle.get('format_version', 1)
+    if format_version < MODEL_FORMAT_VERSION:
+        message = (f'{path} is a version {format_version} model, trained before PositionalEncoding used token '
+                   f'positions (version {MODEL_FORMAT_VERSION}); its predictions will differ from training')
+        if not allow_old_format:
+            raise ValueError(f'{message}. Retrain it, or load it with allow_old_format=True')
+        logging.warning(message)
+    model_args = argparse.Namespace(**bundle['model_args'])
+    labels = bundle['labels']
+    state_dict = bundle['state_dict']
+
+    # The real embedding matrix and label margins are restored from the state dict below
+    embed_weights = torch.zeros_like(state_dict['embedder.weight'])
+    label_freq = [1] * len(labels) if 'class_margin' in state_dict else None
+    model = build_model(model_args, embed_weights, len(labels), device, label_freq)
+    model.load_state_dict(state_dict)
+    model.to(device)
+    model.eval()
+    logging.info(f'Loaded {model_args.model} with {len(labels)} labels from {path}')
+    return model, labels, model_args
+
+
+def set_seed(seed, use_cuda=False):
+    seed = int(seed)
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+    if use_cuda:
+        torch.cuda.manual_seed_all(seed)
+
+
+def get_rng_state():
+    state = {'python': random.getstate(), 'numpy': np.random.get_state(), 'torch': torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def save_checkpoint(path, model, optimizer, epoch, run_data, early_stopping=None, step=None, config=None):
+    """
+    Save everything needed to continue training after epoch: model and optimizer state, the RunManager's
+    per-epoch results so far, the early stopping state (best weights so far), the optimizer steps taken and
+    all RNG states. The file is replaced atomically, so a crash while saving leaves the previous checkpoint intact.
+    :param config: the training configuration (e.g. the TRAIN_ARGS values), checked by load_checkpoint
+    """
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp_path = f'{path}.tmp'
+    torch.save({'epoch': epoch,
+                'step': step,
+                'config': config,
+                'model': model.state_dict(),
+                'optimizer': optimizer.state_dict(),
+                'run_data': run_data,
+                'early_stopping': early_stopping.state_dict() if early_stopping is not None else None,
+                'rng_state': get_rng_state()}, tmp_path)
+    os.replace(tmp_path, path)
+    logging.info(f'Saved checkpoint at epoch {epoch} to {path}')
+
+
+def load_checkpoint(path, model, optimizer, early_stopping=None, config=None):
+    """
+    Restore model, optimizer, early stopping and RNG states saved by save_checkpoint.
+    Raises ValueError if config differs from the configuration the checkpoint was trained with.
+    :return: Returns (number of epochs already trained, RunManager run_data, optimizer steps taken or None
+        for checkpoints that did not record them)
+    """
+    # Checkpoints hold numpy RNG state and results dicts, not only tensors
+    checkpoint = torch.load(path, map_location='cpu', weights_only=False)
+    saved_config = checkpoint.get('config')
+    if config is not None and saved_config is not None and saved_config != config:
+        diff = ', '.join(f'{name}={saved_config.get(name)!r} (now {config.get(name)!r})'
+                         for name in sorted(set(saved_config) | set(config))
+                         if saved_config.get(name) != config.get(name))
+        raise ValueError(f'Checkpoint {path} was trained with {diff}, rerun without --resume or with its arguments')
+    model.load_state_dict(checkpoint['model'])
+    optimizer.load_state_dict(checkpoint['optimizer'])
+    if early_stopping is not None and checkpoint.get('early_stopping') is not None:
+        early_stopping.load_state_dict(checkpoint['early_stopping'])
+    set_rng_state(checkpoint['rng_state'])
+    logging.info(f'Resumed from checkpoint at epoch {checkpoint["epoch"]} in {path}')
+    return checkpoint['epoch'], checkpoint['run_data'], checkpoint.get('step')
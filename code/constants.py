@@ -27,8 +27,13 @@ ICD_DESC_FILE_PATH = os.path.join(DATA_DIR, 'ICD9_descriptions')
 # Generated files
 VOCAB_FILE_PATH = os.path.join(GENERATED_DIR, 'vocab.csv')
 EMBED_FILE_PATH = os.path.join(GENERATED_DIR, 'vocab.embed')
+EMBED_WEIGHTS_PATH = os.path.join(GENERATED_DIR, 'vocab_embed.npy')
+EMBED_VOCAB_PATH = os.path.join(GENERATED_DIR, 'vocab_embed.vocab')
 CODE_FREQ_PATH = os.path.join(GENERATED_DIR, 'code_freq.csv')
 CODE_DESC_VECTOR_PATH = os.path.join(GENERATED_DIR, 'code_desc_vectors.csv')
+STEM_CACHE_PATH = os.path.join(GENERATED_DIR, 'stem_cache.csv')
+STAGE_MANIFEST_PATH = os.path.join(GENERATED_DIR, 'stage_manifest.json')
+CORPUS_DIR = os.path.join(GENERATED_DIR, 'corpus')
 
 # Special tokens
 PAD_SYMBOL = '<PAD>'
@@ -37,6 +42,7 @@ UNK_SYMBOL = '<UNK>'
 # Constants
 FULL = 'full'
 TOP50 = '50'
+SPLITS = ['train', 'dev', 'test']
 
 # Debug version
 def get_args():
@@ -47,6 +53,22 @@ def get_args():
                       help='Directory for storing generated data')
     parser.add_argument('--log', default="INFO", help="Logging level.")
     parser.add_argument('--random_seed', default=271, help="Random seed.")
+    parser.add_argument('--notes_chunksize', type=int, default=100000,
+                      help='Rows per chunk when streaming NOTEEVENTS.csv (0 loads the whole file)')
+    parser.add_argument('--clean_workers', type=int, default=None,
+                      help='Worker processes for text cleaning (defaults to the number of cores)')
+    parser.add_argument('--clean_chunksize', type=int, default=64,
+                      help='Notes sent to a cleaning worker at a time')
+    parser.add_argument('--split_ratios', type=float, nargs=3, default=[0.7, 0.1, 0.2],
+                      help='Train/dev/test fractions of the admissions')
+    parser.add_argument('--build_vocab', action='store_true', default=False,
+                      help='Also build vocab.csv, the Word2Vec embeddings and vocab_embed.npy from the split files')
+    parser.add_argument('--force_stages', action='store_true', default=False,
+                      help='Rerun every preprocessing stage, even those whose outputs are up to date')
+    parser.add_argument('--update_vocab', type=str, default=None,
+                      help='CSV of new raw notes (TEXT column): only extend the vocab and embeddings with them')
+    parser.add_argument('--update_epochs', type=int, default=None,
+                      help='Word2Vec epochs over the new notes in --update_vocab (defaults to the saved model\'s)')
 
     parser.add_argument(
         '--data_setting',
@@ -67,7 +89,7 @@ def get_args():
         type=int,
         default=[30, 35, 40],
         nargs='+',
-        help='Number of epochs to train.'
+        help='Number of epochs to train. Several values are evaluated as snapshots of one training run.'
     )
 
     parser.add_argument(
@@ -82,14 +104,42 @@ def get_args():
         '--batch_size',
         type=int,
         default=8,
-        help='Batch size. Must divide evenly into the dataset sizes.'
+        help='Batch size (examples per forward pass). The last batch of a split may be smaller.'
+    )
+
+    parser.add_argument(
+        '--accumulation_steps',
+        type=int,
+        default=1,
+        help='Batches whose gradients are accumulated per optimizer step (effective batch = batch_size x this)'
+    )
+
+    parser.add_argument(
+        '--bucket_batching',
+        action='store_true',
+        default=False,
+        help='Batch documents of similar length together and pad each batch only to its longest member'
+    )
+
+    parser.add_argument(
+        '--max_tokens',
+        type=int,
+        default=None,
+        help='With --bucket_batching, cap each batch at this many padded tokens instead of batch_size examples'
     )
 
     parser.add_argument(
         '--max_len',
         type=int,
         default=2500,
-        help='Max Length of discharge summary'
+        help='Max Length of discharge summary, longer ones are truncated (0: no limit, needs --chunk_size)'
+    )
+
+    parser.add_argument(
+        '--chunk_size',
+        type=int,
+        default=None,
+        help='Encode notes in independent windows of this many tokens, attention then runs over all windows'
     )
 
     parser.add_argument(
@@ -113,6 +163,13 @@ def get_args():
         help='Expansion factor for attention model'
     )
 
+    parser.add_argument(
+        '--attn_tile_size',
+        type=int,
+        default=None,
+        help='Compute the label attention over tiles of this many tokens with an online softmax, to save memory'
+    )
+
     parser.add_argument(
         '--num_trans_layers',
         type=int,
@@ -141,6 +198,63 @@ def get_args():
         help='Dropout rate for transformers'
     )
 
+    parser.add_argument(
+        '--mixed_precision',
+        action='store_true',
+        default=False,
+        help='Autocast forward passes to bfloat16 (falls back to fp32 where unsupported)'
+    )
+
+    parser.add_argument(
+        '--checkpoint_every',
+        type=int,
+        default=1,
+        help='Save a training checkpoint every this many epochs (0 to disable)'
+    )
+
+    parser.add_argument(
+        '--resume',
+        action='store_true',
+        default=False,
+        help='Resume each run from its checkpoint in ../models/checkpoints if there is one'
+    )
+
+    parser.add_argument(
+        '--sweep_workers',
+        type=int,
+        default=1,
+        help='Number of hyper parameter combinations to train in parallel processes (CPU only)'
+    )
+
+    parser.add_argument(
+        '--num_threads',
+        type=int,
+        default=None,
+        help='Total torch threads, split evenly across sweep workers (default: all cores)'
+    )
+
+    parser.add_argument(
+        '--early_stopping_metric',
+        type=str,
+        default=None,
+        choices=['accuracy', 'f1_micro', 'f1_macro', 'auc_micro', 'auc_macro', 'p@1', 'p@5', 'p@8', 'p@10', 'p@15'],
+        help='Dev metric to monitor for early stopping (default: no early stopping)'
+    )
+
+    parser.add_argument(
+        '--patience',
+        type=int,
+        default=5,
+        help='Stop after this many dev evaluations without improvement'
+    )
+
+    parser.add_argument(
+        '--monitor_steps',
+        type=int,
+        default=0,
+        help='Evaluate the dev metric every this many optimizer steps instead of every epoch'
+    )
+
     args = parser.parse_args()  # '--target_kernel_size 4 8'.split()
     return args
 
@@ -1,8 +1,10 @@
+import os
 import logging
 import torch
 import numpy as np
 import pandas as pd
-from torch.utils.data import Dataset
+from scipy import sparse
+from torch.utils.data import Dataset, Sampler
 from sklearn.preprocessing import MultiLabelBinarizer
 from nltk.corpus import stopwords
 from utils import *
@@ -17,45 +19,39 @@ def remove_stopwords(text):
     return ' '.join(tokens)
 
 
-def load_dataset(data_setting, batch_size, split):
+def load_dataset(data_setting, split):
     data = pd.read_csv(f'{GENERATED_DIR}/{split}_{data_setting}.csv', dtype={'LENGTH': int})
     len_stat = data['LENGTH'].describe()
     logging.info(f'{split} set length stats:\n{len_stat}')
 
-    if data_setting == FULL:
-        code_df = pd.read_csv(f'{CODE_FREQ_PATH}', dtype={'code': str})
-        all_codes = ';'.join(map(str, code_df['code'].values.tolist()))
-        data = data.append({'HADM_ID': -1, 'TEXT': 'remove', 'LABELS': all_codes, 'length': 6},
-                        ignore_index=True)
-
-    mlb = MultiLabelBinarizer()
-    data['LABELS'] = data['LABELS'].apply(lambda x: str(x).split(';'))
-    code_counts = list(data['LABELS'].str.len())
+    labels = data['LABELS'].apply(lambda x: str(x).split(';'))
+    code_counts = list(labels.str.len())
     avg_code_counts = sum(code_counts)/len(code_counts)
     logging.info(f'In {split} set, average code counts per discharge summary: {avg_code_counts}')
-    mlb.fit(data['LABELS'])
-    temp = mlb.transform(data['LABELS'])
-    if mlb.classes_[-1] == 'nan':
-        mlb.classes_ = mlb.classes_[:-1]
-    logging.info(f'Final number of labels/codes: {len(mlb.classes_)}')
-
-    for i, x in enumerate(mlb.classes_):
-        data[x] = temp[:, i]
-    data.drop(['LABELS', 'LENGTH'], axis=1, inplace=True)
 
+    # Labels stay a CSR matrix from here on, they only become dense per batch in ICD_Dataset.collate
+    mlb = MultiLabelBinarizer(sparse_output=True)
     if data_setting == FULL:
-        data = data[:-1]
-
+        # Fit on every code so that all splits share the same label columns
+        code_df = pd.read_csv(f'{CODE_FREQ_PATH}', dtype={'code': str})
+        mlb.fit(list(labels) + [code_df['code'].astype(str).tolist()])
+    else:
+        mlb.fit(labels)
+    targets = mlb.transform(labels).tocsr()
     code_list = list(mlb.classes_)
-    label_freq = list(data[code_list].sum(axis=0))
-    hadm_ids = data['HADM_ID'].values.tolist()
-    texts = data['TEXT'].values.tolist()
-    labels = data[code_list].values.tolist()
-    item_count = (len(texts) // batch_size) * batch_size
-    logging.info(f'{split} set true item count: {item_count}\n\n')
-    return {'hadm_ids': hadm_ids[:item_count],
-            'texts': texts[:item_count],
-            'targets': labels[:item_count],
+    if code_list[-1] == 'nan':
+        code_list = code_list[:-1]
+        targets = targets[:, :-1]
+    logging.info(f'Final number of labels/codes: {len(code_list)}')
+
+    label_freq = np.asarray(targets.sum(axis=0)).ravel().tolist()
+    hadm_ids = data['HADM_ID'].values
+    # A missing note is an empty document, not the token 'nan'
+    texts = data['TEXT'].fillna('').values
+    logging.info(f'{split} set item count: {len(texts)}\n\n')
+    return {'hadm_ids': hadm_ids,
+            'texts': texts,
+            'targets': targets,
             'labels': code_list,
             'label_freq': label_freq}
 
@@ -77,29 +73,77 @@ def get_all_codes(train_path, dev_path, test_path):
     return list(all_codes)
 
 
-def load_datasets(data_setting, batch_size):
-    train_raw = load_dataset(data_setting, batch_size, split='train')
-    dev_raw = load_dataset(data_setting, batch_size, split='dev')
-    test_raw = load_dataset(data_setting, batch_size, split='test')
+def load_datasets(data_setting):
+    train_raw = load_dataset(data_setting, split='train')
+    dev_raw = load_dataset(data_setting, split='dev')
+    test_raw = load_dataset(data_setting, split='test')
 
     if train_raw['labels'] != dev_raw['labels'] or dev_raw['labels'] != test_raw['labels']:
-        raise ValueError(f"Train dev test labels don't match!")
+        raise ValueError("Train dev test labels don't match!")
 
     return train_raw, dev_raw, test_raw
 
 
-def load_embedding_weights():
+def write_embedding_weights(weights, words, weights_path=None, vocab_path=None):
+    """
+    Save the embedding matrix as one contiguous float32 .npy array, plus a sidecar vocab file with
+    one token per line in row order (i.e. Indexer order, starting with PAD and UNK).
+    """
+    weights_path = weights_path or EMBED_WEIGHTS_PATH
+    vocab_path = vocab_path or EMBED_VOCAB_PATH
+    weights = np.asarray(weights, dtype=np.float32)
+    if len(weights) != len(words):
+        raise ValueError(f'{len(weights)} embedding rows for {len(words)} vocab entries')
+    with open(vocab_path, 'w') as fout:
+        for word in words:
+            fout.write(word + '\n')
+    # The matrix is written last, so its presence marks a complete pair
+    np.save(weights_path, weights)
+    logging.info(f'Wrote {weights.shape} embedding matrix to {weights_path}')
+
+
+def load_embedding_vocab(vocab_path=None):
+    with open(vocab_path or EMBED_VOCAB_PATH, 'r') as fin:
+        return [line.rstrip('\n') for line in fin]
+
+
+def convert_text_embedding(text_path=None, weights_path=None, vocab_path=None):
+    """
+    Convert a text vocab.embed (one 'word v1 v2 ...' line per token) into the binary .npy + vocab pair.
+    """
+    words = []
     W = []
-    # PAD and UNK already in embed file
-
-    with open(EMBED_FILE_PATH) as ef:
+    with open(text_path or EMBED_FILE_PATH) as ef:
         for line in ef:
             line = line.rstrip().split()
-            vec = np.array(line[1:]).astype(np.float)
-            # vec = vec / float(np.linalg.norm(vec) + 1e-6)
-            W.append(vec)
+            words.append(line[0])
+            W.append(line[1:])
+    write_embedding_weights(np.array(W, dtype=np.float32), words, weights_path, vocab_path)
+
+
+def load_embedding_weights(indexer=None):
+    """
+    Memory-map the binary embedding matrix, converting an existing text vocab.embed on first use.
+    :param indexer: optional vocab Indexer, checked against the sidecar vocab so rows line up with token ids
+    :return: Returns a V x E float tensor sharing memory with the copy-on-write mapping
+    """
+    if not os.path.exists(EMBED_WEIGHTS_PATH):
+        if not os.path.exists(EMBED_FILE_PATH):
+            raise FileNotFoundError(f'Neither {EMBED_WEIGHTS_PATH} nor {EMBED_FILE_PATH} found, run the preprocessor first')
+        logging.info(f'Converting {EMBED_FILE_PATH} to {EMBED_WEIGHTS_PATH}')
+        convert_text_embedding()
+
+    # PAD and UNK already in embed file
+    W = np.load(EMBED_WEIGHTS_PATH, mmap_mode='c')
+    if indexer is not None:
+        words = load_embedding_vocab()
+        if len(words) != len(indexer):
+            raise ValueError(f'Embedding vocab has {len(words)} tokens but the vocab indexer has {len(indexer)}')
+        for idx, word in enumerate(words):
+            if indexer.index_of(word) != idx:
+                raise ValueError(f'Embedding row {idx} is {word!r} but the vocab indexer maps it to {indexer.index_of(word)}')
     logging.info(f'Total token count (including PAD, UNK) of full preprocessed discharge summaries: {len(W)}')
-    weights = torch.tensor(W, dtype=torch.float)
+    weights = torch.from_numpy(W)
     return weights
 
 
@@ -122,66 +166,253 @@ def load_label_embedding(labels, pad_index):
     return code_desc
 
 
-def index_text(data, indexer, max_len, split):
-    data_indexed = []
-    lens = []
+def load_vocab_indexer(max_size=None):
+    """
+    :param max_size: keep only the first max_size tokens (including PAD, UNK). The vocab only ever grows by
+                     appending, so this is the vocab of a model whose embedding matrix has max_size rows
+    """
+    input_indexer = Indexer()
+    input_indexer.add_and_get_index(PAD_SYMBOL)
+    input_indexer.add_and_get_index(UNK_SYMBOL)
+    with open(VOCAB_FILE_PATH, 'r') as fin:
+        for line in fin:
+            if max_size is not None and len(input_indexer) >= max_size:
+                break
+            word = line.strip()
+            input_indexer.add_and_get_index(word)
+
+    logging.info(f'Size of training vocabulary including PAD, UNK: {len(input_indexer)}')
+    return input_indexer
+
+
+def index_text(data, indexer, split):
+    """
+    Map every document to token ids in one contiguous int32 array.
+    :return: Returns (tokens, offsets) where document i is tokens[offsets[i]:offsets[i+1]], unpadded
+    """
+    unk_idx = indexer.index_of(UNK_SYMBOL)
+    token_ids = indexer.objs_to_ints
+    doc_tokens = []
     oov_word_frac = []
     for text in data:
-        num_oov_words = 0
-        text_indexed = [indexer.index_of(PAD_SYMBOL)]*max_len
-        tokens = text.split()
-        text_len = max_len if len(tokens) > max_len else len(tokens)
-        lens.append(text_len)
-        for i in range(text_len):
-            if indexer.index_of(tokens[i]) >= 0:
-                text_indexed[i] = indexer.index_of(tokens[i])
-            else:
-                num_oov_words += 1
-                text_indexed[i] = indexer.index_of(UNK_SYMBOL)
-        oov_word_frac.append(num_oov_words/text_len)
-        data_indexed.append(text_indexed)
+        tokens = str(text).split()
+        text_indexed = np.fromiter((token_ids.get(token, unk_idx) for token in tokens), dtype=np.int32,
+                                   count=len(tokens))
+        oov_word_frac.append((text_indexed == unk_idx).sum() / max(len(tokens), 1))
+        doc_tokens.append(text_indexed)
     logging.info(f'{split} dataset has on average {sum(oov_word_frac)/len(oov_word_frac)} oov words per discharge summary')
-    return data_indexed, lens
+    offsets = np.zeros(len(doc_tokens) + 1, dtype=np.int64)
+    np.cumsum([len(text_indexed) for text_indexed in doc_tokens], out=offsets[1:])
+    tokens = np.concatenate(doc_tokens) if doc_tokens else np.zeros(0, dtype=np.int32)
+    return tokens, offsets
+
+
+def index_labels(targets):
+    """
+    Pack a 0/1 label matrix (sparse or dense) the same way as the token ids.
+    :return: Returns (label_ids, label_offsets) where document i has codes label_ids[label_offsets[i]:label_offsets[i+1]]
+    """
+    targets = sparse.csr_matrix(targets)
+    targets.sort_indices()
+    return targets.indices.astype(np.int32), targets.indptr.astype(np.int64)
+
+
+def build_corpus(split_data, indexer, split):
+    tokens, offsets = index_text(split_data['texts'], indexer, split)
+    label_ids, label_offsets = index_labels(split_data['targets'])
+    return {'hadm_ids': np.asarray(split_data['hadm_ids'], dtype=np.int64),
+            'tokens': tokens,
+            'offsets': offsets,
+            'label_ids': label_ids,
+            'label_offsets': label_offsets,
+            'codes': np.asarray(split_data['labels'], dtype=str)}
+
+
+def get_corpus_dir(data_setting, split):
+    return os.path.join(CORPUS_DIR, f'{split}_{data_setting}')
+
+
+def corpus_exists(data_setting):
+    return all(os.path.exists(os.path.join(get_corpus_dir(data_setting, split), 'codes.npy')) for split in SPLITS)
+
+
+def write_corpora(data_setting, indexer=None):
+    """Index the train/dev/test CSVs once and save them as .npy arrays under CORPUS_DIR"""
+    indexer = indexer or load_vocab_indexer()
+    for split, split_data in zip(SPLITS, load_datasets(data_setting)):
+        corpus = build_corpus(split_data, indexer, split)
+        corpus_dir = get_corpus_dir(data_setting, split)
+        os.makedirs(corpus_dir, exist_ok=True)
+        # codes.npy is written last and marks the corpus as complete
+        for name in ['hadm_ids', 'tokens', 'offsets', 'label_ids', 'label_offsets', 'codes']:
+            np.save(os.path.join(corpus_dir, f'{name}.npy'), corpus[name])
+        logging.info(f'Wrote {split} corpus with {len(corpus["hadm_ids"])} documents and {len(corpus["tokens"])} tokens to {corpus_dir}')
+
+
+def load_corpus(data_setting, split, mmap_mode='c'):
+    # Copy-on-write maps give writable arrays (so torch can wrap them without copying) whose pages
+    # stay shared with the page cache and across DataLoader workers
+    corpus_dir = get_corpus_dir(data_setting, split)
+    corpus = {}
+    for name in ['hadm_ids', 'tokens', 'offsets', 'label_ids', 'label_offsets', 'codes']:
+        corpus[name] = np.load(os.path.join(corpus_dir, f'{name}.npy'), mmap_mode=None if name == 'codes' else mmap_mode)
+    logging.info(f'Memory-mapped {split} corpus with {len(corpus["hadm_ids"])} documents from {corpus_dir}')
+    return corpus
 
 
 class ICD_Dataset(Dataset):
-    def __init__(self, hadm_ids, texts, lens, labels):
+    """
+    Documents backed by flat token/label id arrays (in memory or memory-mapped). Items are zero-copy
+    views into those arrays; padding to max_len and dense label vectors are only built in collate().
+    Documents are truncated to max_len tokens, a max_len of 0 (or None) keeps them whole.
+    """
+    def __init__(self, hadm_ids, tokens, offsets, label_ids, label_offsets, num_labels, max_len, pad_idx=0,
+                 dynamic_padding=False, codes=None):
         self.hadm_ids = hadm_ids
-        self.texts = texts
-        self.lens = lens
-        self.labels = labels
+        self.tokens = tokens
+        self.offsets = offsets
+        self.label_ids = label_ids
+        self.label_offsets = label_offsets
+        self.num_labels = num_labels
+        self.max_len = max_len
+        self.pad_idx = pad_idx
+        self.dynamic_padding = dynamic_padding
+        self.codes = codes
+
+    @classmethod
+    def from_corpus(cls, corpus, max_len, pad_idx=0, dynamic_padding=False):
+        return cls(corpus['hadm_ids'], corpus['tokens'], corpus['offsets'], corpus['label_ids'],
+                   corpus['label_offsets'], len(corpus['codes']), max_len, pad_idx, dynamic_padding,
+                   corpus['codes'].tolist())
 
     def __len__(self):
-        return len(self.texts)
+        return len(self.hadm_ids)
 
     def get_code_count(self):
-        return len(self.labels[0])
+        return self.num_labels
 
-    def __getitem__(self, index):
-        hadm_id = torch.tensor(self.hadm_ids[index])
-        text = torch.tensor(self.texts[index], dtype=torch.long)
-        length = torch.tensor(self.lens[index], dtype=torch.long)
-        codes = torch.tensor(self.labels[index], dtype=torch.float)
-        return {'hadm_id': hadm_id, 'text': text, 'length': length, 'codes': codes}
+    def get_label_freq(self):
+        return np.bincount(self.label_ids, minlength=self.num_labels).tolist()
 
+    def get_lens(self):
+        if not self.max_len:
+            return np.diff(self.offsets)
+        return np.minimum(np.diff(self.offsets), self.max_len)
 
-def prepare_datasets(data_setting, batch_size, max_len):
-    train_data, dev_data, test_data = load_datasets(data_setting, batch_size)
-    input_indexer = Indexer()
-    input_indexer.add_and_get_index(PAD_SYMBOL)
-    input_indexer.add_and_get_index(UNK_SYMBOL)
-    with open(VOCAB_FILE_PATH, 'r') as fin:
-        for line in fin:
-            word = line.strip()
-            input_indexer.add_and_get_index(word)
-
-    logging.info(f'Size of training vocabulary including PAD, UNK: {len(input_indexer)}')
-
-    train_text_indexed, train_lens = index_text(train_data['texts'], input_indexer, max_len, split='train')
-    dev_text_indexed, dev_lens = index_text(dev_data['texts'], input_indexer, max_len, split='dev')
-    test_text_indexed, test_lens = index_text(test_data['texts'], input_indexer, max_len, split='test')
+    def __getitem__(self, index):
+        start = self.offsets[index]
+        end = self.offsets[index + 1]
+        if self.max_len:
+            end = min(end, start + self.max_len)
+        hadm_id = torch.tensor(int(self.hadm_ids[index]))
+        text = torch.from_numpy(self.tokens[start:end])
+        length = torch.tensor(end - start, dtype=torch.long)
+        label_ids = torch.from_numpy(self.label_ids[self.label_offsets[index]:self.label_offsets[index + 1]])
+        return {'hadm_id': hadm_id, 'text': text, 'length': length, 'label_ids': label_ids}
+
+    def collate(self, batch):
+        """
+        Pad token id views into a B x S tensor and expand label ids into a dense B x L matrix.
+        S is max_len, or the longest document in the batch when dynamic_padding is set or there is no max_len.
+        """
+        lengths = torch.stack([item['length'] for item in batch])
+        seq_len = max(int(lengths.max()), 1) if self.dynamic_padding or not self.max_len else self.max_len
+        texts = torch.full((len(batch), seq_len), self.pad_idx, dtype=torch.long)
+        codes = torch.zeros((len(batch), self.num_labels), dtype=torch.float)
+        for i, item in enumerate(batch):
+            texts[i, :len(item['text'])] = item['text']
+            codes[i, item['label_ids'].long()] = 1
+        return {'hadm_id': torch.stack([item['hadm_id'] for item in batch]),
+                'text': texts,
+                'length': lengths,
+                'codes': codes}
+
+
+class BucketBatchSampler(Sampler):
+    """
+    Groups documents of similar length into the same batch so that dynamic padding wastes little.
+    Shuffled indices are cut into pools of bucket_size_multiplier batches, each pool is sorted by length
+    and split into batches, and the batch order is shuffled. With max_tokens set, a batch is closed once
+    its padded size (batch size x longest member) would exceed max_tokens instead of at batch_size examples,
+    so the number of batches then changes from epoch to epoch. Shuffles come from a generator seeded with
+    seed + epoch rather than the global RNG, so len() can look at an epoch's batches without side effects.
+    Iterating moves on to the next epoch, set_epoch() picks one (e.g. when resuming).
+    Without shuffle, the whole dataset is sorted by length.
+    """
+    def __init__(self, lens, batch_size, max_tokens=None, shuffle=True, bucket_size_multiplier=100, seed=None):
+        self.lens = np.asarray(lens)
+        self.batch_size = batch_size
+        self.max_tokens = max_tokens
+        self.shuffle = shuffle
+        self.bucket_size_multiplier = bucket_size_multiplier
+        if seed is None and shuffle:
+            seed = int(torch.empty((), dtype=torch.int64).random_().item())
+        self.seed = seed
+        self.epoch = 0
+        self._cached = None
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def _split(self, indices):
+        if not self.max_tokens:
+            return [indices[i:i + self.batch_size] for i in range(0, len(indices), self.batch_size)]
+        batches = []
+        batch = []
+        longest = 0
+        for idx in indices:
+            idx_len = max(int(self.lens[idx]), 1)
+            if batch and max(longest, idx_len) * (len(batch) + 1) > self.max_tokens:
+                batches.append(batch)
+                batch = []
+                longest = 0
+            batch.append(idx)
+            longest = max(longest, idx_len)
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def _batches(self):
+        if self._cached is not None and self._cached[0] == self.epoch:
+            return self._cached[1]
+        if not self.shuffle:
+            batches = self._split(np.argsort(self.lens, kind='stable').tolist())
+        else:
+            generator = torch.Generator().manual_seed(self.seed + self.epoch)
+            indices = torch.randperm(len(self.lens), generator=generator).tolist()
+            pool_size = self.batch_size * self.bucket_size_multiplier
+            pooled = []
+            for i in range(0, len(indices), pool_size):
+                pool = sorted(indices[i:i + pool_size], key=lambda idx: self.lens[idx])
+                pooled.extend(self._split(pool))
+            batches = [pooled[i] for i in torch.randperm(len(pooled), generator=generator).tolist()]
+        self._cached = (self.epoch, batches)
+        return batches
+
+    def __iter__(self):
+        batches = self._batches()
+        self.epoch += 1
+        return iter(batches)
 
-    train_set = ICD_Dataset(train_data['hadm_ids'], train_text_indexed, train_lens, train_data['targets'])
-    dev_set = ICD_Dataset(dev_data['hadm_ids'], dev_text_indexed, dev_lens, dev_data['targets'])
-    test_set = ICD_Dataset(test_data['hadm_ids'], test_text_indexed, test_lens, test_data['targets'])
-    return train_set, dev_set, test_set, train_data['labels'], train_data['label_freq'], input_indexer
+    def __len__(self):
+        if not self.max_tokens:
+            return (len(self.lens) + self.batch_size - 1) // self.batch_size
+        return len(self._batches())
+
+
+def prepare_datasets(data_setting, max_len, dynamic_padding=False):
+    input_indexer = load_vocab_indexer()
+    if corpus_exists(data_setting):
+        corpora = [load_corpus(data_setting, split) for split in SPLITS]
+        labels = [corpus['codes'].tolist() for corpus in corpora]
+        if labels[0] != labels[1] or labels[1] != labels[2]:
+            raise ValueError("Train dev test labels don't match!")
+    else:
+        logging.info(f'No token-ID corpus under {CORPUS_DIR}, indexing CSV splits')
+        corpora = [build_corpus(split_data, input_indexer, split)
+                   for split, split_data in zip(SPLITS, load_datasets(data_setting))]
+
+    pad_idx = input_indexer.index_of(PAD_SYMBOL)
+    train_set, dev_set, test_set = [ICD_Dataset.from_corpus(corpus, max_len, pad_idx, dynamic_padding)
+                                    for corpus in corpora]
+    return train_set, dev_set, test_set, corpora[0]['codes'].tolist(), train_set.get_label_freq(), input_indexer
@@ -1,20 +1,26 @@
 import logging
-import numpy as np
 from collections import OrderedDict
 from collections import namedtuple
 from itertools import product
 import constants
 from models import *
 from data import prepare_datasets, load_embedding_weights, load_label_embedding
-from trainer import train
-import random
+from trainer import train, get_run_name
+from checkpoint import TRAIN_ARGS, save_model, set_seed
+from run_manager import RunManager
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
 import os
 
+# Datasets and embedding weights shared with forked sweep workers, set by run() before the pool starts
+_sweep_state = {}
+
 
 def get_hyper_params_combinations(args):
+    # Each run trains for the longest requested num_epoch, trainer.train evaluates the shorter ones as snapshots
     params = OrderedDict(
         learning_rate=args.learning_rate,
-        num_epoch=args.num_epoch
+        num_epoch=[max(args.num_epoch)]
     )
 
     HyperParams = namedtuple('HyperParams', params.keys())
@@ -24,28 +30,71 @@ def get_hyper_params_combinations(args):
     return hyper_params_list
 
 
+def train_combination(args, device, hyper_params, datasets, embed_weights):
+    """Train and evaluate one hyper parameter combination from a fixed seed and return its RunManager results"""
+    train_set, dev_set, test_set, train_labels, train_label_freq = datasets
+    # Seeding per combination makes each run independent of the order (or process) it runs in
+    set_seed(int(args.random_seed), device.type == 'cuda')
+    label_desc = None # load_label_embedding(train_labels, input_indexer.index_of(constants.PAD_SYMBOL))
+    model = build_model(args, embed_weights, train_set.get_code_count(), device, train_label_freq, label_desc)
+    model.to(device)
+    logging.info(f"Training with: {hyper_params}")
+    return train(model, train_set, dev_set, test_set, hyper_params, args.batch_size, device,
+                 bucket_batching=args.bucket_batching, max_tokens=args.max_tokens,
+                 mixed_precision=args.mixed_precision, eval_epochs=args.num_epoch,
+                 # One checkpoint per configuration whatever num_epoch is, so --resume can also extend a schedule
+                 checkpoint_path=f'../models/checkpoints/{args.model}_{get_run_name(hyper_params, ["num_epoch"])}.ckpt',
+                 checkpoint_config=dict({name: getattr(args, name) for name in TRAIN_ARGS},
+                                        learning_rate=hyper_params.learning_rate),
+                 checkpoint_every=args.checkpoint_every, resume=args.resume,
+                 early_stopping_metric=args.early_stopping_metric, patience=args.patience,
+                 monitor_steps=args.monitor_steps, accumulation_steps=args.accumulation_steps,
+                 on_snapshot=lambda run_name: save_model(f'../models/{args.model}_{run_name}.pt', model, args,
+                                                         train_labels))
+
+
+def _init_sweep_worker(num_threads):
+    torch.set_num_threads(num_threads)
+
+
+def _sweep_worker(combination_idx):
+    args = _sweep_state['args']
+    hyper_params = get_hyper_params_combinations(args)[combination_idx]
+    return train_combination(args, _sweep_state['device'], hyper_params, _sweep_state['datasets'],
+                             _sweep_state['embed_weights'])
+
+
 def run(args, device):
-    train_set, dev_set, test_set, train_labels, train_label_freq, input_indexer = prepare_datasets(args.data_setting, args.batch_size, args.max_len)
+    train_set, dev_set, test_set, train_labels, train_label_freq, input_indexer = prepare_datasets(
+        args.data_setting, args.max_len, dynamic_padding=args.bucket_batching)
     logging.info(f'Taining labels are: {train_labels}\n')
-    embed_weights = load_embedding_weights()
-    label_desc = None # load_label_embedding(train_labels, input_indexer.index_of(constants.PAD_SYMBOL))
-    model = None
-    for hyper_params in get_hyper_params_combinations(args):
-        if args.model == 'Transformer':
-            model = Transformer(embed_weights, args.embed_size, args.freeze_embed, args.max_len, args.num_trans_layers,
-                                args.num_attn_heads, args.trans_forward_expansion, train_set.get_code_count(),
-                                args.dropout_rate, device)
-        elif args.model == 'TransICD':
-            model = TransICD(embed_weights, args.embed_size, args.freeze_embed, args.max_len, args.num_trans_layers,
-                             args.num_attn_heads, args.trans_forward_expansion, train_set.get_code_count(),
-                             args.label_attn_expansion, args.dropout_rate, label_desc, device, train_label_freq)
-        else:
-            raise ValueError("Unknown value for args.model. Pick Transformer or TransICD")
-        
-        if model:
-            model.to(device)
-            logging.info(f"Training with: {hyper_params}")
-            train(model, train_set, dev_set, test_set, hyper_params, args.batch_size, device)
+    embed_weights = load_embedding_weights(input_indexer)
+    datasets = (train_set, dev_set, test_set, train_labels, train_label_freq)
+    hyper_params_list = get_hyper_params_combinations(args)
+
+    num_workers = min(args.sweep_workers, len(hyper_params_list))
+    if num_workers > 1 and device.type != 'cpu':
+        logging.warning(f'Parallel sweeps only run on CPU, training {len(hyper_params_list)} combinations one by one')
+        num_workers = 1
+
+    m = RunManager()
+    if num_workers > 1:
+        num_threads = max(1, (args.num_threads or os.cpu_count()) // num_workers)
+        logging.info(f'Sweeping {len(hyper_params_list)} combinations with {num_workers} workers, '
+                     f'{num_threads} threads each')
+        # Forked workers share the memory-mapped corpus and embedding matrix with this process
+        _sweep_state.update(args=args, device=device, datasets=datasets, embed_weights=embed_weights)
+        with ProcessPoolExecutor(num_workers, mp_context=multiprocessing.get_context('fork'),
+                                 initializer=_init_sweep_worker, initargs=(num_threads,)) as executor:
+            for run_data in executor.map(_sweep_worker, range(len(hyper_params_list))):
+                m.add_run(run_data)
+        _sweep_state.clear()
+    else:
+        if args.num_threads:
+            torch.set_num_threads(args.num_threads)
+        for hyper_params in hyper_params_list:
+            m.add_run(train_combination(args, device, hyper_params, datasets, embed_weights))
+    m.save('../results/sweep_results')
 
 
 if __name__ == "__main__":
@@ -57,9 +106,5 @@ if __name__ == "__main__":
     logging.info(f'{args}\n')
     use_cuda = torch.cuda.is_available()
     device = torch.device("cuda" if use_cuda else "cpu")
-    random.seed(args.random_seed)
-    np.random.seed(args.random_seed)
-    torch.manual_seed(args.random_seed)
-    if use_cuda:
-        torch.cuda.manual_seed_all(args.random_seed)
+    set_seed(int(args.random_seed), use_cuda)
     run(args, device)
@@ -3,17 +3,30 @@ import torch.nn as nn
 import torch.nn.functional as F
 import math
 from torch.nn import TransformerEncoder, TransformerEncoderLayer
+from torch.utils.checkpoint import checkpoint
 
 
 class Attention(nn.Module):
-    def __init__(self, hidden_size, output_size, attn_expansion, dropout_rate):
+    """
+    Label-wise attention over the token positions. With tile_size set, the output is computed tile by tile
+    over the sequence with an online softmax (running max and sum per label), so the B x S x L scores are
+    never held at once; each tile is recomputed in the backward pass instead of being stored.
+    """
+    def __init__(self, hidden_size, output_size, attn_expansion, dropout_rate, tile_size=None):
         super(Attention, self).__init__()
         self.l1 = nn.Linear(hidden_size, hidden_size*attn_expansion)
         self.tnh = nn.Tanh()
         # self.dropout = nn.Dropout(dropout_rate)
         self.l2 = nn.Linear(hidden_size*attn_expansion, output_size)
+        self.tile_size = tile_size
 
     def forward(self, hidden, attn_mask=None):
+        """
+        :return: Returns (weighted_output B x O x H, attn_weights B x O x S), attn_weights is None when tiled
+        """
+        if self.tile_size:
+            return self._tiled_forward(hidden, attn_mask), None
+
         # output_1: B x S x H -> B x S x attn_expansion*H
         output_1 = self.tnh(self.l1(hidden))
         # output_1 = self.dropout(output_1)
@@ -32,6 +45,94 @@ class Attention(nn.Module):
         weighted_output = attn_weights @ hidden
         return weighted_output, attn_weights
 
+    def _tile(self, hidden, attn_mask):
+        # Unnormalized softmax statistics of one tile: max B x O, sum B x O and weighted sum B x O x H
+        output_2 = self.l2(self.tnh(self.l1(hidden)))
+        if attn_mask is not None:
+            output_2 = output_2.masked_fill(attn_mask == 0, -1e9)
+        tile_max = output_2.max(dim=1).values
+        exp_scores = torch.exp(output_2 - tile_max.unsqueeze(1))
+        return tile_max, exp_scores.sum(dim=1), exp_scores.transpose(1, 2) @ hidden
+
+    def _tiled_forward(self, hidden, attn_mask):
+        run_max, run_sum, run_output = None, None, None
+        for start in range(0, hidden.size(1), self.tile_size):
+            hidden_tile = hidden[:, start:start + self.tile_size]
+            mask_tile = attn_mask[:, start:start + self.tile_size] if attn_mask is not None else None
+            if torch.is_grad_enabled():
+                tile_max, tile_sum, tile_output = checkpoint(self._tile, hidden_tile, mask_tile, use_reentrant=False)
+            else:
+                tile_max, tile_sum, tile_output = self._tile(hidden_tile, mask_tile)
+            if run_max is None:
+                run_max, run_sum, run_output = tile_max, tile_sum, tile_output
+                continue
+            # Rescale both sides to the new running max before adding them up
+            new_max = torch.maximum(run_max, tile_max)
+            run_scale = torch.exp(run_max - new_max)
+            tile_scale = torch.exp(tile_max - new_max)
+            run_sum = run_sum * run_scale + tile_sum * tile_scale
+            run_output = run_output * run_scale.unsqueeze(2) + tile_output * tile_scale.unsqueeze(2)
+            run_max = new_max
+        return run_output / run_sum.unsqueeze(2)
+
+    def label_weights(self, hidden, attn_mask, labels):
+        """
+        Attention weights of a subset of labels only, e.g. the top predicted codes.
+        :param labels: B x k label indices
+        :return: Returns B x k x S attention weights, same values as the matching rows of forward()'s attn_weights
+        """
+        weight = self.l2.weight[labels]  # B x k x attn_expansion*H
+        bias = self.l2.bias[labels]  # B x k
+        tile_size = self.tile_size or hidden.size(1)
+        scores = []
+        for start in range(0, hidden.size(1), tile_size):
+            output_1 = self.tnh(self.l1(hidden[:, start:start + tile_size]))
+            scores.append(torch.einsum('bsh,bkh->bsk', output_1, weight) + bias.unsqueeze(1))
+        scores = torch.cat(scores, dim=1)
+        if attn_mask is not None:
+            scores = scores.masked_fill(attn_mask == 0, -1e9)
+        return F.softmax(scores, dim=1).transpose(1, 2)
+
+
+class LabelwiseLinear(nn.Module):
+    """
+    One nn.Linear(in_features, 1) per label, stored as a single L x H weight so that all labels are
+    computed in one batched op. Accepts B x L x H (a separate input per label) or B x H (shared input).
+    State dicts saved with the old ModuleList of per-label linears (fcs.{i}.weight/bias) are converted on load.
+    """
+    def __init__(self, in_features, num_labels):
+        super(LabelwiseLinear, self).__init__()
+        self.in_features = in_features
+        self.num_labels = num_labels
+        self.weight = nn.Parameter(torch.empty(num_labels, in_features))
+        self.bias = nn.Parameter(torch.empty(num_labels))
+        self.reset_parameters()
+
+    def reset_parameters(self):
+        # Same distribution and draw order as num_labels separate nn.Linear(in_features, 1) layers
+        bound = 1 / math.sqrt(self.in_features)
+        with torch.no_grad():
+            for label in range(self.num_labels):
+                nn.init.kaiming_uniform_(self.weight[label:label+1], a=math.sqrt(5))
+                nn.init.uniform_(self.bias[label:label+1], -bound, bound)
+
+    def forward(self, inputs):
+        if inputs.dim() == 3:
+            # (B x L x H) * (L x H) -> B x L
+            return torch.einsum('blh,lh->bl', inputs, self.weight) + self.bias
+        # (B x H) @ (H x L) -> B x L
+        return F.linear(inputs, self.weight, self.bias)
+
+    def _load_from_state_dict(self, state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys,
+                              error_msgs):
+        legacy_keys = [f'{prefix}{label}.weight' for label in range(self.num_labels)]
+        if prefix + 'weight' not in state_dict and legacy_keys[0] in state_dict:
+            state_dict[prefix + 'weight'] = torch.cat([state_dict.pop(key) for key in legacy_keys], dim=0)
+            state_dict[prefix + 'bias'] = torch.cat([state_dict.pop(f'{prefix}{label}.bias')
+                                                     for label in range(self.num_labels)], dim=0)
+        super(LabelwiseLinear, self)._load_from_state_dict(state_dict, prefix, local_metadata, strict, missing_keys,
+                                                           unexpected_keys, error_msgs)
+
 
 class LabelAttention(nn.Module):
     def __init__(self, hidden_size, label_embed_size, dropout_rate):
@@ -74,57 +175,103 @@ class PositionalEncoding(nn.Module):
         self.register_buffer('pe', pe)
 
     def forward(self, x):
-        x = x + self.pe[:x.size(0), :].to(x.device)
+        # x: B x S x E, pe: max_len x 1 x E -> 1 x S x E, one encoding per token position
+        x = x + self.pe[:x.size(1)].transpose(0, 1).to(x.device)
         return self.dropout(x)
 
 
+def encode_tokens(inputs, embedder, pos_encoder, dropout, encoder, pad_idx, chunk_size=None):
+    """
+    Embed and encode B x S token ids. With chunk_size, each note is cut into windows of chunk_size tokens
+    (the last one padded) that go through the encoder as one batch of independent windows, so the cost grows
+    linearly with S instead of quadratically. Windows without any tokens are not encoded.
+    :return: Returns (encoded tokens B x S' x E, padding mask B x S') where S' is S, rounded up to a
+             multiple of chunk_size in chunked mode
+    """
+    embed_size = embedder.embedding_dim
+    if chunk_size:
+        pad_len = -inputs.size(1) % chunk_size
+        if pad_len:
+            inputs = F.pad(inputs, (0, pad_len), value=pad_idx)
+        windows = inputs.reshape(-1, chunk_size)  # B*n x C
+    else:
+        windows = inputs
+    padding_mask = windows == pad_idx
+
+    # The encoder cannot attend over a window that is only padding, those stay zero
+    has_tokens = ~padding_mask.all(dim=1)
+    if not has_tokens.any():
+        # e.g. a batch of empty notes, the encoder cannot run on zero windows
+        encoded = embedder.weight.new_zeros(inputs.size(0), inputs.size(1), embed_size)
+        return encoded, padding_mask.reshape(inputs.size(0), -1)
+    all_have_tokens = bool(has_tokens.all())
+    if not all_have_tokens:
+        windows = windows[has_tokens]
+
+    embeds = pos_encoder(embedder(windows) * math.sqrt(embed_size))  # N x S x E
+    embeds = dropout(embeds)
+    embeds = embeds.permute(1, 0, 2)  # S x N x E
+    window_mask = padding_mask if all_have_tokens else padding_mask[has_tokens]
+    encoded = encoder(embeds, src_key_padding_mask=window_mask)  # T x N x E
+    encoded = encoded.permute(1, 0, 2)  # N x T x E
+
+    if not all_have_tokens:
+        all_encoded = encoded.new_zeros(padding_mask.size(0), padding_mask.size(1), embed_size)
+        all_encoded[has_tokens] = encoded
+        encoded = all_encoded
+    return encoded.reshape(inputs.size(0), -1, embed_size), padding_mask.reshape(inputs.size(0), -1)
+
+
 class Transformer(nn.Module):
     def __init__(self, embed_weights, embed_size, freeze_embed, max_len, num_layers, num_heads, forward_expansion,
-                 output_size, dropout_rate, device, pad_idx=0):
+                 output_size, dropout_rate, device, pad_idx=0, chunk_size=None):
         super(Transformer, self).__init__()
         if embed_size % num_heads != 0:
             raise ValueError(f"Embedding size {embed_size} needs to be divisible by number of heads {num_heads}")
+        if not max_len and not chunk_size:
+            raise ValueError("Unlimited max_len needs a chunk_size")
         self.embed_size = embed_size
         self.device = device
         self.pad_idx = pad_idx
         self.output_size = output_size
+        self.chunk_size = chunk_size
 
         self.embedder = nn.Embedding.from_pretrained(embed_weights, freeze=freeze_embed)
         self.dropout = nn.Dropout(dropout_rate)
-        self.pos_encoder = PositionalEncoding(embed_size, dropout_rate, max_len)
+        # Positions restart in every chunk
+        self.pos_encoder = PositionalEncoding(embed_size, dropout_rate, chunk_size or max_len)
         encoder_layers = TransformerEncoderLayer(d_model=embed_size, nhead=num_heads,
                                                  dim_feedforward=forward_expansion*embed_size, dropout=dropout_rate)
         self.encoder = TransformerEncoder(encoder_layers, num_layers)
-        self.fcs = nn.ModuleList([nn.Linear(embed_size, 1) for code in range(output_size)])
+        self.fcs = LabelwiseLinear(embed_size, output_size)
 
-    def forward(self, inputs, targets=None):
-        src_key_padding_mask = (inputs == self.pad_idx).to(self.device)  # N x S
+    def forward(self, inputs, targets=None, attn_top_k=None):
+        # encoded_inputs: N x T x E, src_key_padding_mask: N x T
+        encoded_inputs, src_key_padding_mask = encode_tokens(inputs.to(self.device), self.embedder, self.pos_encoder,
+                                                             self.dropout, self.encoder, self.pad_idx, self.chunk_size)
 
-        embeds = self.pos_encoder(self.embedder(inputs) * math.sqrt(self.embed_size))  # N x S x E
-        embeds = self.dropout(embeds)
-        embeds = embeds.permute(1, 0, 2)  # S x N x E
-
-        encoded_inputs = self.encoder(embeds, src_key_padding_mask=src_key_padding_mask)  # T x N x E
-        encoded_inputs = encoded_inputs.permute(1, 0, 2)  # N x T x E
-
-        pooled_outputs = encoded_inputs.mean(dim=1)
-        outputs = torch.zeros((pooled_outputs.size(0), self.output_size)).to(self.device)
-        for code, fc in enumerate(self.fcs):
-            outputs[:, code:code+1] = fc(pooled_outputs)
+        # Mean over real tokens only, so the pooled vector does not depend on how far the batch is padded
+        token_mask = (~src_key_padding_mask).unsqueeze(2).float()
+        pooled_outputs = (encoded_inputs * token_mask).sum(dim=1) / token_mask.sum(dim=1).clamp(min=1)
+        outputs = self.fcs(pooled_outputs)
 
         return outputs, None, None
 
 
 class TransICD(nn.Module):
     def __init__(self, embed_weights, embed_size, freeze_embed, max_len, num_layers, num_heads, forward_expansion,
-                 output_size, attn_expansion, dropout_rate, label_desc, device, label_freq=None, C=3.0,  pad_idx=0):
+                 output_size, attn_expansion, dropout_rate, label_desc, device, label_freq=None, C=3.0,  pad_idx=0,
+                 chunk_size=None, attn_tile_size=None):
         super(TransICD, self).__init__()
         if embed_size % num_heads != 0:
             raise ValueError(f"Embedding size {embed_size} needs to be divisible by number of heads {num_heads}")
+        if not max_len and not chunk_size:
+            raise ValueError("Unlimited max_len needs a chunk_size")
         self.embed_size = embed_size
         self.device = device
         self.pad_idx = pad_idx
         self.output_size = output_size
+        self.chunk_size = chunk_size
         # self.register_buffer('label_desc', label_desc)
         # self.register_buffer('label_desc_mask', (self.label_desc != self.pad_idx)*1.0)
 
@@ -139,43 +286,69 @@ class TransICD(nn.Module):
 
         self.embedder = nn.Embedding.from_pretrained(embed_weights, freeze=freeze_embed)
         self.dropout = nn.Dropout(dropout_rate)
-        self.pos_encoder = PositionalEncoding(embed_size, dropout_rate, max_len)
+        # Positions restart in every chunk
+        self.pos_encoder = PositionalEncoding(embed_size, dropout_rate, chunk_size or max_len)
         encoder_layers = TransformerEncoderLayer(d_model=embed_size, nhead=num_heads,
                                                  dim_feedforward=forward_expansion*embed_size, dropout=dropout_rate)
         self.encoder = TransformerEncoder(encoder_layers, num_layers)
-        self.attn = Attention(embed_size, output_size, attn_expansion, dropout_rate)
+        self.attn = Attention(embed_size, output_size, attn_expansion, dropout_rate, attn_tile_size)
         # self.label_attn = LabelAttention(embed_size, embed_size, dropout_rate)
-        self.fcs = nn.ModuleList([nn.Linear(embed_size, 1) for code in range(output_size)])
+        self.fcs = LabelwiseLinear(embed_size, output_size)
 
     def embed_label_desc(self):
         label_embeds = self.embedder(self.label_desc).transpose(1, 2).matmul(self.label_desc_mask.unsqueeze(2))
         label_embeds = torch.div(label_embeds.squeeze(2), torch.sum(self.label_desc_mask, dim=-1).unsqueeze(1))
         return label_embeds
 
-    def forward(self, inputs, targets=None):
+    def forward(self, inputs, targets=None, attn_top_k=None):
+        """
+        :param attn_top_k: if given, attn_weights are only returned for each example's attn_top_k highest-scoring
+               labels (B x k x S, in outputs.topk order), otherwise for all labels (B x L x S, None when tiled)
+        """
+        # encoded_inputs: N x T x E, src_key_padding_mask: N x T (chunk outputs concatenated in chunked mode)
+        encoded_inputs, src_key_padding_mask = encode_tokens(inputs.to(self.device), self.embedder, self.pos_encoder,
+                                                             self.dropout, self.encoder, self.pad_idx, self.chunk_size)
         # attn_mask: B x S -> B x S x 1
-        attn_mask = (inputs != self.pad_idx).unsqueeze(2).to(self.device)
-        src_key_padding_mask = (inputs == self.pad_idx).to(self.device)  # N x S
-
-        embeds = self.pos_encoder(self.embedder(inputs) * math.sqrt(self.embed_size))  # N x S x E
-        embeds = self.dropout(embeds)
-        embeds = embeds.permute(1, 0, 2)  # S x N x E
-
-        encoded_inputs = self.encoder(embeds, src_key_padding_mask=src_key_padding_mask)  # T x N x E
-        encoded_inputs = encoded_inputs.permute(1, 0, 2)  # N x T x E
+        attn_mask = (~src_key_padding_mask).unsqueeze(2)
 
         # encoded_inputs is of shape: batch_size, seq_len, embed_size
         weighted_outputs, attn_weights = self.attn(encoded_inputs, attn_mask)
         # label_embeds = self.embed_label_desc()
         # weighted_outputs, attn_weights = self.label_attn(encoded_inputs, label_embeds, attn_mask)
 
-        outputs = torch.zeros((weighted_outputs.size(0), self.output_size)).to(self.device)
-        for code, fc in enumerate(self.fcs):
-            outputs[:, code:code+1] = fc(weighted_outputs[:, code, :])
+        # weighted_outputs: B x L x H -> outputs: B x L, one linear per label
+        outputs = self.fcs(weighted_outputs)
 
         if targets is not None and self.class_margin is not None and self.C > 0:
             ldam_outputs = outputs - targets * self.class_margin * self.C
         else:
             ldam_outputs = None
 
+        if attn_top_k:
+            top_labels = outputs.topk(min(attn_top_k, outputs.size(1)), dim=1).indices
+            if attn_weights is not None:
+                attn_weights = attn_weights.gather(1, top_labels.unsqueeze(2).expand(-1, -1, attn_weights.size(2)))
+            else:
+                attn_weights = self.attn.label_weights(encoded_inputs, attn_mask, top_labels)
+
         return outputs, ldam_outputs, attn_weights
+
+
+def build_model(args, embed_weights, output_size, device, label_freq=None, label_desc=None):
+    """Instantiate the model named by args.model from the command line hyperparameters"""
+    # nn.Embedding.from_pretrained trains the tensor in place, so a fine-tuned embedding gets its own copy of the
+    # shared (memory-mapped) matrix. A frozen one keeps sharing it, e.g. across forked sweep workers
+    if not args.freeze_embed:
+        embed_weights = embed_weights.clone()
+    # Models saved before chunked encoding or tiled attention have no chunk_size / attn_tile_size
+    if args.model == 'Transformer':
+        return Transformer(embed_weights, args.embed_size, args.freeze_embed, args.max_len, args.num_trans_layers,
+                           args.num_attn_heads, args.trans_forward_expansion, output_size, args.dropout_rate, device,
+                           chunk_size=getattr(args, 'chunk_size', None))
+    elif args.model == 'TransICD':
+        return TransICD(embed_weights, args.embed_size, args.freeze_embed, args.max_len, args.num_trans_layers,
+                        args.num_attn_heads, args.trans_forward_expansion, output_size, args.label_attn_expansion,
+                        args.dropout_rate, label_desc, device, label_freq,
+                        chunk_size=getattr(args, 'chunk_size', None), attn_tile_size=getattr(args, 'attn_tile_size', None))
+    else:
+        raise ValueError("Unknown value for args.model. Pick Transformer or TransICD")
@@ -0,0 +1,167 @@
+import os
+import sys
+import csv
+import json
+import time
+import logging
+import argparse
+import numpy as np
+import torch
+import constants
+from checkpoint import load_model
+from data import load_vocab_indexer
+from preprocessor import clean_text, trantab, my_stopwords, stemmer
+
+
+class Predictor(object):
+    """
+    Scores raw discharge summaries with a trained model. The model, the vocab Indexer and the label list are
+    loaded once. Notes go through the same clean_text preprocessing as the training data and are batched by
+    length, so each batch is only padded to its longest note.
+
+    Attributes:
+        model
+        labels: code of each output column
+        indexer: vocab Indexer the model's embedding rows follow
+        max_len: notes are truncated to this many tokens, as in training (0: no limit)
+    """
+    def __init__(self, model_path, device=None, num_threads=None, allow_old_format=False):
+        if num_threads:
+            torch.set_num_threads(num_threads)
+        self.device = device or torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+        self.model, self.labels, model_args = load_model(model_path, self.device, allow_old_format)
+        self.max_len = model_args.max_len
+        embed_rows = self.model.embedder.weight.size(0)
+        # Models trained before an incremental vocab update only know its first embed_rows tokens
+        self.indexer = load_vocab_indexer(max_size=embed_rows)
+        if len(self.indexer) != embed_rows:
+            raise ValueError(f'Vocab has {len(self.indexer)} tokens but the model embeds {embed_rows}')
+        self.unk_idx = self.indexer.index_of(constants.UNK_SYMBOL)
+        self.pad_idx = self.indexer.index_of(constants.PAD_SYMBOL)
+        if os.path.exists(constants.STEM_CACHE_PATH):
+            stemmer.load(constants.STEM_CACHE_PATH)
+
+    def encode(self, text):
+        """
+        :return: Returns the cleaned note as int64 token ids, truncated to max_len if set
+        """
+        tokens = clean_text(str(text), trantab, my_stopwords, stemmer).split()[:self.max_len or None]
+        if not tokens:
+            # A note with nothing left after cleaning would be all padding, which the encoder cannot attend over
+            tokens = [constants.UNK_SYMBOL]
+        token_ids = self.indexer.objs_to_ints
+        return np.fromiter((token_ids.get(token, self.unk_idx) for token in tokens), dtype=np.int64, count=len(tokens))
+
+    def predict_encoded(self, encoded, top_k):
+        """
+        :param encoded: list of token id arrays, all scored in one forward pass
+        :return: Returns (top_k probabilities, top_k label indices), both B x top_k numpy arrays
+        """
+        seq_len = max(max(len(token_ids) for token_ids in encoded), 1)
+        texts = torch.full((len(encoded), seq_len), self.pad_idx, dtype=torch.long)
+        for i, token_ids in enumerate(encoded):
+            texts[i, :len(token_ids)] = torch.from_numpy(token_ids)
+        with torch.no_grad():
+            outputs, _, _ = self.model(texts.to(self.device))
+            top = torch.sigmoid(outputs.float()).topk(min(top_k, len(self.labels)), dim=1)
+        return top.values.cpu().numpy(), top.indices.cpu().numpy()
+
+    def predict(self, texts, top_k=5, batch_size=32):
+        """
+        :param texts: list of raw notes
+        :return: Returns one [(code, probability)] list per note, most probable first, in input order
+        """
+        encoded = [self.encode(text) for text in texts]
+        # Sort by length so that notes of similar length share a batch
+        order = np.argsort([len(token_ids) for token_ids in encoded], kind='stable')
+        predictions = [None] * len(texts)
+        for start in range(0, len(order), batch_size):
+            batch_idx = order[start:start + batch_size]
+            probabs, indices = self.predict_encoded([encoded[i] for i in batch_idx], top_k)
+            for i, row_probabs, row_indices in zip(batch_idx, probabs, indices):
+                predictions[i] = [(self.labels[j], float(p)) for j, p in zip(row_indices, row_probabs)]
+        return predictions
+
+    def predict_stream(self, records, top_k=5, batch_size=32, buffer_batches=16):
+        """
+        Score an iterable of (note id, raw text) without reading it all into memory. Records are buffered
+        buffer_batches batches at a time for length sorting and yielded back in input order.
+        :return: Yields (note id, [(code, probability)])
+        """
+        buffer = []
+        for record in records:
+            buffer.append(record)
+            if len(buffer) == batch_size * buffer_batches:
+                yield from zip([note_id for note_id, _ in buffer],
+                               self.predict([text for _, text in buffer], top_k, batch_size))
+                buffer = []
+        if buffer:
+            yield from zip([note_id for note_id, _ in buffer],
+                           self.predict([text for _, text in buffer], top_k, batch_size))
+
+
+def read_notes(fin, input_format, text_field='TEXT', id_field='HADM_ID'):
+    """
+    :param fin: open text file with one note per JSONL line or CSV row
+    :return: Yields (note id, raw text), the id defaults to the note's position in the input
+    """
+    if input_format == 'csv':
+        rows = csv.DictReader(fin)
+    else:
+        rows = (json.loads(line) for line in fin if line.strip())
+    for i, row in enumerate(rows):
+        if isinstance(row, str):
+            yield i, row
+        else:
+            yield row.get(id_field, i), row[text_field]
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Predict ICD codes for discharge summaries')
+    parser.add_argument('--model_path', required=True, help='Model saved by main.py, e.g. ../models/TransICD_<hype>.pt')
+    parser.add_argument('--input', default='-', help='JSONL or CSV file of notes, - for stdin')
+    parser.add_argument('--output', default='-', help='JSONL file of predictions, - for stdout')
+    parser.add_argument('--input_format', choices=['jsonl', 'csv'], default=None,
+                        help='Input format, inferred from the file extension by default (jsonl for stdin)')
+    parser.add_argument('--text_field', default='TEXT', help='Field/column holding the note text')
+    parser.add_argument('--id_field', default='HADM_ID', help='Field/column holding the note id')
+    parser.add_argument('--top_k', type=int, default=5, help='Number of codes to output per note')
+    parser.add_argument('--batch_size', type=int, default=32, help='Notes per forward pass')
+    parser.add_argument('--num_threads', type=int, default=None, help='Torch intra-op threads (default: torch default)')
+    parser.add_argument('--allow_old_format', action='store_true',
+                        help='Also load models saved before the positional encoding fix (their scores will be off)')
+    parser.add_argument('--log', default="INFO", help="Logging level.")
+    return parser.parse_args()
+
+
+def main(args):
+    predictor = Predictor(args.model_path, num_threads=args.num_threads, allow_old_format=args.allow_old_format)
+    input_format = args.input_format or ('csv' if args.input.endswith('.csv') else 'jsonl')
+    fin = sys.stdin if args.input == '-' else open(args.input, 'r', newline='')
+    fout = sys.stdout if args.output == '-' else open(args.output, 'w')
+
+    start_time = time.time()
+    num_notes = 0
+    try:
+        records = read_notes(fin, input_format, args.text_field, args.id_field)
+        for note_id, codes in predictor.predict_stream(records, args.top_k, args.batch_size):
+            fout.write(json.dumps({'id': note_id, 'codes': [{'code': code, 'probability': probability}
+                                                            for code, probability in codes]}) + '\n')
+            num_notes += 1
+    finally:
+        if fin is not sys.stdin:
+            fin.close()
+        if fout is not sys.stdout:
+            fout.close()
+
+    duration = time.time() - start_time
+    logging.info(f'Predicted {num_notes} notes in {duration:.2f}s ({num_notes / max(duration, 1e-9):.2f} notes/sec) '
+                 f'with batch size {args.batch_size} and {torch.get_num_threads()} threads')
+    print(f'{num_notes} notes, {num_notes / max(duration, 1e-9):.2f} notes/sec', file=sys.stderr)
+
+
+if __name__ == "__main__":
+    args = get_args()
+    FORMAT = '%(asctime)-15s %(message)s'
+    logging.basicConfig(format=FORMAT, level=getattr(logging, args.log.upper()), stream=sys.stderr)
+    main(args)
@@ -1,15 +1,18 @@
 import logging
 import pandas as pd
+from pandas.api.types import union_categoricals
 import numpy as np
 from sklearn.feature_extraction.text import CountVectorizer
 import constants
+import data
+from stage_cache import StageCache
 from nltk.corpus import stopwords
 from nltk.stem import SnowballStemmer
 import re
 import string
 from gensim.models import Word2Vec
 import multiprocessing
-from collections import defaultdict, Counter
+from collections import defaultdict, Counter, OrderedDict
 import csv
 import os
 from tqdm import tqdm
@@ -23,10 +26,116 @@ my_stopwords.update({'admission', 'birth', 'date', 'discharge', 'service', 'sex'
 
                         , 'history',
                      'hospital', 'last', 'first', 'course', 'past', 'day', 'one', 'family', 'chief', 'complaint'})
-stemmer = SnowballStemmer('english')
+
+
+class StemCache(object):
+    """
+    Bounded LRU cache in front of a stemmer, keyed by the raw token. Clinical text has a
+    heavy-tailed vocabulary, so a few thousand distinct tokens cover most stem() calls.
+
+    Attributes:
+        stemmer: wrapped stemmer, anything with a stem(token) method
+        max_size: maximum number of cached tokens
+        hits, misses: lookup counts since creation (or since the last drain in a worker)
+    """
+    def __init__(self, stemmer, max_size=500000):
+        self.stemmer = stemmer
+        self.max_size = max_size
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.new_stems = None
+
+    def stem(self, token):
+        stem = self.cache.get(token)
+        if stem is not None:
+            self.hits += 1
+            self.cache.move_to_end(token)
+            return stem
+        self.misses += 1
+        stem = self.stemmer.stem(token)
+        self.add(token, stem)
+        if self.new_stems is not None:
+            self.new_stems[token] = stem
+        return stem
+
+    def add(self, token, stem):
+        self.cache[token] = stem
+        if len(self.cache) > self.max_size:
+            self.cache.popitem(last=False)
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def stats(self):
+        return {'size': len(self.cache), 'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hit_rate()}
+
+    def track_new_stems(self):
+        """Start recording newly computed stems and counting hits/misses from zero (used in pool workers)"""
+        self.new_stems = {}
+        self.hits = 0
+        self.misses = 0
+
+    def drain(self):
+        """
+        :return: Returns (new_stems, hits, misses) accumulated since the last drain and resets them
+        """
+        delta = (self.new_stems, self.hits, self.misses)
+        self.track_new_stems()
+        return delta
+
+    def merge(self, new_stems, hits, misses):
+        """Fold a worker's drained stems and counts into this cache"""
+        for token, stem in new_stems.items():
+            self.add(token, stem)
+        self.hits += hits
+        self.misses += misses
+
+    def save(self, path=constants.STEM_CACHE_PATH):
+        with open(path, 'w', newline='') as fout:
+            w = csv.writer(fout)
+            for token, stem in self.cache.items():
+                w.writerow([token, stem])
+        logging.info(f'Saved {len(self.cache)} cached stems to {path}')
+
+    def load(self, path=constants.STEM_CACHE_PATH):
+        """
+        Preload stems saved by an earlier run
+        :return: Returns the number of stems loaded
+        """
+        num_loaded = 0
+        with open(path, 'r', newline='') as fin:
+            for token, stem in csv.reader(fin):
+                self.add(token, stem)
+                num_loaded += 1
+        logging.info(f'Loaded {num_loaded} cached stems from {path}')
+        return num_loaded
+
+
+stemmer = StemCache(SnowballStemmer('english'))
 punct = string.punctuation.replace('-', '') + ''.join(["``", "`", "..."])
 trantab = str.maketrans(punct, len(punct) * ' ')
 
+# Category values that identify discharge summaries in NOTEEVENTS
+DISCHARGE_CATEGORIES = [
+    'discharge summary',
+    'discharge summaries',
+    'discharge',
+    'summary',
+    'Discharge summary',
+    'Discharge Summary',
+    'DISCHARGE SUMMARY',
+    'Discharge note',
+    'Discharge Report'
+]
+CATEGORY_COLUMNS = ['CATEGORY', 'CATEGORY_DESCRIPTION', 'DESCRIPTION']
+
+# Intermediate files, relative to the working directory like the MIMIC paths in .env
+DISCH_FILE_PATH = 'mimicdata/processed/discharge_summaries.csv'
+DISCH_HADM_IDS_FILE_PATH = 'mimicdata/processed/discharge_hadm_ids.csv'
+PROC_BY_ADMISSION_FILE_PATH = 'mimicdata/processed/procedures_by_admission.csv'
+
 
 # Credit: https://github.com/jamesmullenbach/caml-mimic
 def reformat(code, is_diag):
@@ -48,28 +157,92 @@ def reformat(code, is_diag):
     return code
 
 
-def combine_diag_proc_codes(hadm_id_set, out_filename='ALL_CODES_filtered.csv'):
-    logging.info("Started Preprocessing raw MIMIC-III data")
-    diag_df = pd.read_csv(constants.DIAGNOSES_FILE_PATH, dtype={"ICD9_CODE": str})
-    proc_df = pd.read_csv(constants.PORCEDURES_FILE_PATH, dtype={"ICD9_CODE": str})
+def reformat_codes(codes, is_diag):
+    """
+    Vectorized reformat: every distinct code is reformatted once with pandas string ops and mapped back.
+    :param codes: Series of ICD9 codes without missing values
+    :return: Returns the reformatted codes as a categorical Series with the same index
+    """
+    codes = codes.astype('category')
+    uniques = pd.Series(codes.cat.categories.astype(str)).str.replace('.', '', regex=False)
+    if is_diag:
+        split = np.where(uniques.str.startswith('E'), 4, 3)
+        head = uniques.str[:3].where(split == 3, uniques.str[:4])
+        tail = uniques.str[3:].where(split == 3, uniques.str[4:])
+        reformatted = head.where(tail == '', head + '.' + tail)
+    else:
+        reformatted = uniques.str[:2] + '.' + uniques.str[2:]
+    # Codes that only differed by a dot before (e.g. 4019 and 401.9) now share a category
+    categories, category_index = np.unique(reformatted.values.astype(str), return_inverse=True)
+    return pd.Series(pd.Categorical.from_codes(category_index[codes.cat.codes.values], categories=categories),
+                     index=codes.index)
+
 
-    diag_df['ICD9_CODE'] = diag_df['ICD9_CODE'].apply(lambda code: str(reformat(str(code), True)))
-    proc_df['ICD9_CODE'] = proc_df['ICD9_CODE'].apply(lambda code: str(reformat(str(code), False)))
-    codes_df = pd.concat([diag_df, proc_df], ignore_index=True)
-    num_original_hadm_id = len(codes_df['HADM_ID'].unique())
+def read_code_table(file_path, is_diag):
+    """
+    :return: Returns SUBJECT_ID, HADM_ID, ICD9_CODE of a MIMIC-III DIAGNOSES_ICD / PROCEDURES_ICD file, with
+             upper case column names whatever their case in the file, and reformatted categorical codes
+    """
+    columns = pd.read_csv(file_path, nrows=0).columns
+    names = {}
+    for name in ['SUBJECT_ID', 'HADM_ID', 'ICD9_CODE']:
+        col = find_column(columns, [name])
+        if col is None:
+            raise KeyError(f'Could not find {name} column in {file_path}, available columns: {columns.tolist()}')
+        names[col] = name
+    code_col = next(col for col, name in names.items() if name == 'ICD9_CODE')
+    codes_df = pd.read_csv(file_path, usecols=list(names), dtype={code_col: 'category'}).rename(columns=names)
+
+    num_missing = codes_df['ICD9_CODE'].isna().sum()
+    if num_missing:
+        logging.info(f'Dropping {num_missing} rows without ICD9_CODE from {file_path}')
+        codes_df = codes_df.dropna(subset=['ICD9_CODE'])
+    codes_df['ICD9_CODE'] = reformat_codes(codes_df['ICD9_CODE'], is_diag)
+    return codes_df
+
+
+def combine_diag_proc_codes(hadm_id_set, out_filename='ALL_CODES_filtered.csv', labels_filename='ALL_CODES_labels.csv'):
+    """
+    Write the diagnosis and procedure codes of the admissions in hadm_id_set, plus each admission's codes as one
+    ';'-joined LABELS string (the format of the split CSVs), distinct codes in table order.
+    :return: Returns (out_filename, labels DataFrame with HADM_ID and LABELS columns)
+    """
+    logging.info("Started Preprocessing raw MIMIC-III data")
+    diag_df = read_code_table(constants.DIAGNOSES_FILE_PATH, True)
+    proc_df = read_code_table(constants.PROCEDURES_FILE_PATH, False)
+    codes = union_categoricals([diag_df['ICD9_CODE'], proc_df['ICD9_CODE']], ignore_order=True)
+    codes_df = pd.DataFrame({'SUBJECT_ID': np.concatenate([diag_df['SUBJECT_ID'].values, proc_df['SUBJECT_ID'].values]),
+                             'HADM_ID': np.concatenate([diag_df['HADM_ID'].values, proc_df['HADM_ID'].values]),
+                             'ICD9_CODE': codes})
+    num_original_hadm_id = codes_df['HADM_ID'].nunique()
     logging.info(f'Total unique HADM_ID (original): {num_original_hadm_id}')
 
-    codes_df = codes_df[codes_df['HADM_ID'].isin(hadm_id_set)]
-    codes_df.sort_values(['SUBJECT_ID', 'HADM_ID'], inplace=True)
-    num_filtered_hadm_id = len(codes_df['HADM_ID'].unique())
+    codes_df = codes_df[codes_df['HADM_ID'].isin(list(hadm_id_set))]
+    # Stable, so diagnoses keep their SEQ_NUM order and come before procedures within an admission
+    codes_df = codes_df.sort_values(['SUBJECT_ID', 'HADM_ID'], kind='mergesort')
+    codes_df['ICD9_CODE'] = codes_df['ICD9_CODE'].cat.remove_unused_categories()
+    num_filtered_hadm_id = codes_df['HADM_ID'].nunique()
     logging.info(f'Total unique HADM_ID (ALL_CODES_filtered): {num_filtered_hadm_id}')
-    num_unique_codes = len(codes_df['ICD9_CODE'].unique())
+    num_unique_codes = len(codes_df['ICD9_CODE'].cat.categories)
     logging.info(f'Total unique ICD9_CODE (ALL_CODES_filtered): {num_unique_codes}')
     codes_df.to_csv(f'{constants.GENERATED_DIR}/{out_filename}', index=False,
-               columns=['SUBJECT_ID', 'HADM_ID', 'ICD9_CODE'],
-               header=['SUBJECT_ID', 'HADM_ID', 'ICD9_CODE'])
-
-    return out_filename
+                    columns=['SUBJECT_ID', 'HADM_ID', 'ICD9_CODE'],
+                    header=['SUBJECT_ID', 'HADM_ID', 'ICD9_CODE'])
+
+    # After the sort each admission's rows are contiguous, so its label string is a join over one slice
+    distinct_df = codes_df.drop_duplicates(['HADM_ID', 'ICD9_CODE'])
+    hadm_ids = distinct_df['HADM_ID'].values
+    codes = distinct_df['ICD9_CODE']
+    code_strs = np.asarray(codes.cat.categories, dtype=object)[codes.cat.codes.values].tolist()
+    is_start = np.ones(len(hadm_ids), dtype=bool)
+    is_start[1:] = hadm_ids[1:] != hadm_ids[:-1]
+    starts = np.flatnonzero(is_start)
+    ends = np.r_[starts[1:], len(hadm_ids)]
+    labels_df = pd.DataFrame({'HADM_ID': hadm_ids[starts],
+                              'LABELS': [';'.join(code_strs[start:end]) for start, end in zip(starts, ends)]})
+    labels_df.to_csv(f'{constants.GENERATED_DIR}/{labels_filename}', index=False)
+    logging.info(f'Wrote labels of {len(labels_df)} admissions to {constants.GENERATED_DIR}/{labels_filename}')
+    return out_filename, labels_df
 
 
 def clean_text(text, trantab, my_stopwords=None, stemmer=None):
@@ -91,17 +264,70 @@ def clean_text(text, trantab, my_stopwords=None, stemmer=None):
     return text
 
 
+def _init_clean_worker():
+    stemmer.track_new_stems()
+
+
+def _clean_text_worker(text):
+    text = clean_text(str(text), trantab, my_stopwords, stemmer)
+    return text, stemmer.drain()
+
+
+def clean_pool(num_workers=None):
+    """
+    :return: Returns a process pool for clean_texts, or None when num_workers means cleaning in this process
+    """
+    num_workers = num_workers or multiprocessing.cpu_count()
+    if num_workers <= 1:
+        return None
+    return multiprocessing.Pool(num_workers, initializer=_init_clean_worker)
+
+
+def clean_texts(texts, num_workers=None, chunksize=64, pool=None):
+    """
+    Clean a batch of texts with clean_text, sharding them across a process pool.
+    Yields the cleaned texts lazily, in the same order as the input.
+    :param pool: pool from clean_pool to reuse across calls, by default one is started for these texts only
+    """
+    if pool is None:
+        pool = clean_pool(num_workers)
+        if pool is None:
+            for text in texts:
+                yield clean_text(str(text), trantab, my_stopwords, stemmer)
+            return
+        with pool:
+            yield from clean_texts(texts, chunksize=chunksize, pool=pool)
+        return
+    for text, stem_delta in pool.imap(_clean_text_worker, texts, chunksize=chunksize):
+        # Workers only send back stems they had to compute, so the parent cache keeps learning
+        stemmer.merge(*stem_delta)
+        yield text
+
+
+_clean_code_desc = {}
+
+
+def load_clean_code_desc(num_workers=None, chunksize=64):
+    """Code descriptions cleaned with clean_text, computed once per process"""
+    if not _clean_code_desc:
+        desc_dict = load_code_desc()
+        _clean_code_desc.update(zip(desc_dict.keys(), clean_texts(desc_dict.values(), num_workers, chunksize)))
+    return _clean_code_desc
+
+
+def get_data_path(env_var):
+    """Resolve a MIMIC file path from the environment"""
+    path = os.getenv(env_var)
+    if not os.path.isabs(path):
+        path = os.path.abspath(os.path.join(os.getcwd(), path))
+    return path
+
+
 def load_mimic_data():
     """Load MIMIC data from CSV files"""
     try:
-        notes_path = os.getenv('MIMIC_NOTES_PATH')
-        procedures_path = os.getenv('MIMIC_PROCEDURES_PATH')
-        
-        # Convert relative paths to absolute if needed
-        if not os.path.isabs(notes_path):
-            notes_path = os.path.abspath(os.path.join(os.getcwd(), notes_path))
-        if not os.path.isabs(procedures_path):
-            procedures_path = os.path.abspath(os.path.join(os.getcwd(), procedures_path))
+        notes_path = get_data_path('MIMIC_NOTES_PATH')
+        procedures_path = get_data_path('MIMIC_PROCEDURES_PATH')
         
         print(f"\nLoading data from:")
         print(f"NOTEEVENTS: {notes_path}")
@@ -134,6 +360,69 @@ def load_mimic_data():
         raise
 
 
+def load_procedures_data():
+    """Load only PROCEDURES_ICD, leaving NOTEEVENTS on disk"""
+    procedures_path = get_data_path('MIMIC_PROCEDURES_PATH')
+    procedures_df = pd.read_csv(procedures_path)
+    print("\nPROCEDURES.csv info:")
+    print(f"Shape: {procedures_df.shape}")
+    return procedures_df
+
+
+def find_column(columns, candidates):
+    """Return the first of the candidate column names present in columns (case-insensitive)"""
+    upper_cols = {col.upper(): col for col in columns}
+    for candidate in candidates:
+        if candidate.upper() in upper_cols:
+            return upper_cols[candidate.upper()]
+    return None
+
+
+def stream_discharge_summaries(notes_path, chunksize=100000):
+    """
+    Read NOTEEVENTS in chunks, keeping only discharge summaries and, for each HADM_ID,
+    only the latest note seen so far. Peak memory is bounded by the discharge summary
+    subset plus one chunk instead of the whole file.
+    """
+    columns = pd.read_csv(notes_path, nrows=0).columns
+    category_col = find_column(columns, CATEGORY_COLUMNS)
+    if category_col is None:
+        raise KeyError(
+            "Could not find category column in NOTEEVENTS.csv.\n"
+            f"Available columns: {columns.tolist()}\n"
+            "Expected one of: CATEGORY, CATEGORY_DESCRIPTION, or DESCRIPTION"
+        )
+    sort_col = find_column(columns, ['CHARTDATE', 'CHARTTIME'])
+    if sort_col is None:
+        raise KeyError("Could not find CHARTDATE or CHARTTIME column in NOTEEVENTS.csv")
+    hadm_col = find_column(columns, ['HADM_ID'])
+    usecols = [col for col in [find_column(columns, ['SUBJECT_ID']), hadm_col, sort_col, category_col,
+                               find_column(columns, ['TEXT'])] if col is not None]
+
+    pattern = '|'.join(DISCHARGE_CATEGORIES)
+    print(f"\nStreaming {notes_path} in chunks of {chunksize} rows (columns: {usecols})")
+    latest_df = None
+    num_notes = 0
+    num_disch_notes = 0
+    reader = pd.read_csv(notes_path, usecols=usecols, chunksize=chunksize, dtype={category_col: str})
+    for chunk in tqdm(reader, desc='NOTEEVENTS chunks'):
+        num_notes += len(chunk)
+        chunk = chunk[chunk[category_col].str.contains(pattern, case=False, na=False)]
+        chunk = chunk.dropna(subset=[hadm_col])
+        num_disch_notes += len(chunk)
+        if latest_df is not None:
+            chunk = pd.concat([latest_df, chunk], ignore_index=True)
+        # Stable sort so that, on equal chart dates, the note appearing later in the file wins
+        latest_df = chunk.sort_values([hadm_col, sort_col], kind='mergesort').groupby(hadm_col).last().reset_index()
+
+    print(f"Total number of notes: {num_notes}")
+    print(f"Found {num_disch_notes} discharge summaries for {0 if latest_df is None else len(latest_df)} admissions")
+    if latest_df is None or len(latest_df) == 0:
+        raise ValueError("No discharge summaries found in the dataset")
+    latest_df[hadm_col] = latest_df[hadm_col].astype('int64')
+    return latest_df, hadm_col
+
+
 def validate_data_files():
     """Validate that required data files exist"""
     required_files = [
@@ -158,10 +447,31 @@ def validate_data_files():
         raise FileNotFoundError("Missing required MIMIC files")
 
 
-def write_discharge_summaries():
-    """Process and write discharge summaries"""
-    notes_df, _ = load_mimic_data()
+def write_discharge_summaries(chunksize=None):
+    """Process and write discharge summaries, streaming NOTEEVENTS when chunksize is set"""
+    if chunksize:
+        disch_df, hadm_col = stream_discharge_summaries(get_data_path('MIMIC_NOTES_PATH'), chunksize)
+    else:
+        disch_df, hadm_col = select_discharge_summaries(load_mimic_data()[0]), 'HADM_ID'
+
+    # Create output directory if it doesn't exist
+    os.makedirs('mimicdata/processed', exist_ok=True)
     
+    # Write processed discharge summaries
+    output_filename = DISCH_FILE_PATH
+    disch_df.to_csv(output_filename, index=False)
+    # Later stages only need the admission ids, which are cheap to reload from their own file
+    hadm_ids = disch_df[hadm_col].unique()
+    pd.DataFrame({'HADM_ID': hadm_ids}).to_csv(DISCH_HADM_IDS_FILE_PATH, index=False)
+    
+    print(f"\nWrote {len(disch_df)} discharge summaries to {output_filename}")
+    
+    # Return set of HADM_IDs and filename
+    return set(hadm_ids), output_filename
+
+
+def select_discharge_summaries(notes_df):
+    """Select the latest discharge summary per admission from an in-memory NOTEEVENTS frame"""
     print("\nDataset Overview:")
     print(f"Total number of notes: {len(notes_df)}")
     
@@ -208,17 +518,7 @@ def write_discharge_summaries():
     print(f"\nUsing {category_col} column to identify discharge summaries")
     
     # Select discharge summaries - try different possible category values
-    possible_categories = [
-        'discharge summary',
-        'discharge summaries',
-        'discharge',
-        'summary',
-        'Discharge summary',
-        'Discharge Summary',
-        'DISCHARGE SUMMARY',
-        'Discharge note',
-        'Discharge Report'
-    ]
+    possible_categories = DISCHARGE_CATEGORIES
     
     # Print all unique categories before filtering
     print(f"\nAll unique values in {category_col} column:")
@@ -263,34 +563,54 @@ def write_discharge_summaries():
     
     # Sort and get latest note for each admission
     disch_df = disch_df.sort_values(['HADM_ID', sort_col]).groupby('HADM_ID').last().reset_index()
-    
-    # Create output directory if it doesn't exist
-    os.makedirs('mimicdata/processed', exist_ok=True)
-    
-    # Write processed discharge summaries
-    output_filename = 'mimicdata/processed/discharge_summaries.csv'
-    disch_df.to_csv(output_filename, index=False)
-    
-    print(f"\nWrote {len(disch_df)} discharge summaries to {output_filename}")
-    
-    # Return set of HADM_IDs and filename
-    return set(disch_df['HADM_ID'].unique()), output_filename
+    return disch_df
+
+
+def write_clean_discharge_summaries(disch_filename, out_filename='disch_full.csv', num_workers=None,
+                                    chunksize=64, read_chunksize=5000):
+    """
+    Clean discharge summary text in parallel and write it with token lengths. The file is read in chunks of
+    read_chunksize rows that are all fed to one process pool.
+    """
+    out_file_path = f'{constants.GENERATED_DIR}/{out_filename}'
+    columns = pd.read_csv(disch_filename, nrows=0).columns
+    usecols = [find_column(columns, ['SUBJECT_ID']), find_column(columns, ['HADM_ID']), find_column(columns, ['TEXT'])]
+    num_written = 0
+    pool = clean_pool(num_workers)
+    try:
+        for i, chunk in enumerate(pd.read_csv(disch_filename, usecols=usecols, chunksize=read_chunksize)):
+            chunk.columns = [col.upper() for col in chunk.columns]
+            chunk['TEXT'] = list(clean_texts(chunk['TEXT'].fillna(''), num_workers, chunksize, pool))
+            chunk['LENGTH'] = chunk['TEXT'].str.split().str.len()
+            chunk[['SUBJECT_ID', 'HADM_ID', 'TEXT', 'LENGTH']].to_csv(out_file_path, mode='w' if i == 0 else 'a',
+                                                                     header=(i == 0), index=False)
+            num_written += len(chunk)
+    finally:
+        if pool is not None:
+            pool.terminate()
+    logging.info(f'Wrote {num_written} cleaned discharge summaries to {out_file_path}')
+    return out_filename
 
 
 def process_procedures():
     """Process procedures data"""
-    _, procedures_df = load_mimic_data()
+    procedures_df = load_procedures_data()
+    procedures_df.columns = [col.upper() for col in procedures_df.columns]
     
     # Group procedures by admission
     proc_by_admission = procedures_df.groupby('HADM_ID')['ICD9_CODE'].apply(list).reset_index()
     
     # Write processed procedures
-    output_filename = 'mimicdata/processed/procedures_by_admission.csv'
+    output_filename = PROC_BY_ADMISSION_FILE_PATH
     proc_by_admission.to_csv(output_filename, index=False)
     
     return proc_by_admission
 
 
+def get_split_hadm_ids_paths():
+    return [f'mimicdata/caml/{split}_{setting}_hadm_ids.csv' for setting in ['full', '50'] for split in constants.SPLITS]
+
+
 def create_datasets(hadm_ids, split_ratios=[0.7, 0.1, 0.2]):
     """Create train/dev/test splits"""
     hadm_ids = list(hadm_ids)
@@ -319,18 +639,17 @@ def create_datasets(hadm_ids, split_ratios=[0.7, 0.1, 0.2]):
     pd.Series(test_ids[:len(test_ids)//2]).to_csv('mimicdata/caml/test_50_hadm_ids.csv', index=False)
 
 
-def build_vocab(train_full_filename='train_full.csv', out_filename='vocab.csv'):
+def build_vocab(train_full_filename='train_full.csv', out_filename='vocab.csv', num_workers=None, chunksize=64):
     train_df = pd.read_csv(f'{constants.GENERATED_DIR}/{train_full_filename}')
-    desc_dt = load_code_desc()
-    desc_series = pd.Series(list(desc_dt.values())).apply(lambda text: clean_text(text, trantab, my_stopwords, stemmer))
+    desc_series = pd.Series(list(load_clean_code_desc(num_workers, chunksize).values()))
 
-    full_text_series = train_df['TEXT'].append(desc_series, ignore_index=True)
+    full_text_series = pd.concat([train_df['TEXT'].fillna(''), desc_series], ignore_index=True)
     cv = CountVectorizer(min_df=1)
     cv.fit(full_text_series)
 
     out_file_path = f'{constants.GENERATED_DIR}/{out_filename}'
     with open(out_file_path, 'w') as fout:
-        for word in cv.get_feature_names():
+        for word in cv.get_feature_names_out():
             fout.write(f'{word}\n')
 
 
@@ -362,62 +681,159 @@ def load_code_desc():
     return desc_dict
 
 
-def embed_words(disch_full_filename='disch_full.csv', embed_size=128, out_filename='disch_full.w2v'):
-    disch_df = pd.read_csv(f'{constants.GENERATED_DIR}/{disch_full_filename}')
-    sentences = [text.split() for text in disch_df['TEXT']]
-    desc_dt = load_code_desc()
-    for desc in desc_dt.values():
-        sentences.append(clean_text(desc, trantab, my_stopwords, stemmer).split())
+def write_sentence_corpus(disch_full_filename='disch_full.csv', out_filename='disch_full.sentences',
+                          read_chunksize=5000, num_workers=None, chunksize=64):
+    """
+    Write the cleaned discharge summaries and code descriptions as a LineSentence corpus (one sentence of space
+    separated tokens per line), reading disch_full.csv in chunks so memory stays flat in the corpus size
+    """
+    out_file_path = f'{constants.GENERATED_DIR}/{out_filename}'
+    num_sentences = 0
+    with open(out_file_path, 'w') as fout:
+        for chunk in pd.read_csv(f'{constants.GENERATED_DIR}/{disch_full_filename}', usecols=['TEXT'],
+                                 chunksize=read_chunksize):
+            for text in chunk['TEXT'].fillna(''):
+                fout.write(' '.join(str(text).split()) + '\n')
+            num_sentences += len(chunk)
+        for desc in load_clean_code_desc(num_workers, chunksize).values():
+            fout.write(' '.join(desc.split()) + '\n')
+            num_sentences += 1
+    logging.info(f'Wrote {num_sentences} sentences to {out_file_path}')
+    return out_filename
+
+
+def embed_words(corpus_filename='disch_full.sentences', embed_size=128, out_filename='disch_full.w2v', min_count=0,
+                window=5, num_negatives=5, epochs=30, clean_workers=None, clean_chunksize=64):
+    """
+    Train CBOW embeddings streaming from the LineSentence corpus on disk (written by write_sentence_corpus if
+    missing). With corpus_file every worker reads its own byte range of the file, so both passes run in parallel
+    without the tokenized corpus ever being held in memory.
+    """
+    corpus_file_path = f'{constants.GENERATED_DIR}/{corpus_filename}'
+    if not os.path.exists(corpus_file_path):
+        write_sentence_corpus(out_filename=corpus_filename, num_workers=clean_workers, chunksize=clean_chunksize)
 
-    num_cores = multiprocessing.cpu_count()
-    min_count = 0
-    window = 5
-    num_negatives = 5
+    num_workers = max(multiprocessing.cpu_count() - 1, 1)
     logging.info('\n**********************************************\n')
     logging.info('Training CBOW embedding...')
-    logging.info(f'Params: embed_size={embed_size}, workers={num_cores-1}, min_count={min_count}, window={window}, negative={num_negatives}')
-    w2v_model = Word2Vec(min_count=min_count, window=window, size=embed_size, negative=num_negatives, workers=num_cores-1)
-    w2v_model.build_vocab(sentences, progress_per=10000)
-    w2v_model.train(sentences, total_examples=w2v_model.corpus_count, epochs=30, report_delay=1)
+    logging.info(f'Params: embed_size={embed_size}, workers={num_workers}, min_count={min_count}, window={window}, negative={num_negatives}')
+    w2v_model = Word2Vec(min_count=min_count, window=window, vector_size=embed_size, negative=num_negatives,
+                         workers=num_workers)
+    w2v_model.build_vocab(corpus_file=corpus_file_path, progress_per=10000)
+    w2v_model.train(corpus_file=corpus_file_path, total_examples=w2v_model.corpus_count,
+                    total_words=w2v_model.corpus_total_words, epochs=epochs, report_delay=1)
     w2v_model.init_sims(replace=True)
     w2v_model.save(f'{constants.GENERATED_DIR}/{out_filename}')
     logging.info('\n**********************************************\n')
     return out_filename
 
 
-def map_vocab_to_embed(vocab_filename='vocab.csv', embed_filename='disch_full.w2v', out_filename='vocab.embed'):
+def map_vocab_to_embed(vocab_filename='vocab.csv', embed_filename='disch_full.w2v'):
     model = Word2Vec.load(f'{constants.GENERATED_DIR}/{embed_filename}')
     wv = model.wv
     del model
 
-    embed_size = len(wv.word_vec(wv.index2word[0]))
-    word_to_idx = {}
-    with open(f'{constants.GENERATED_DIR}/{vocab_filename}', 'r') as fin, open(f'{constants.GENERATED_DIR}/{out_filename}', 'w') as fout:
-        pad_embed = np.zeros(embed_size)
-        unk_embed = np.random.randn(embed_size)
-        unk_embed_normalized = unk_embed / float(np.linalg.norm(unk_embed) + 1e-6)
-        fout.write(constants.PAD_SYMBOL + ' ' + np.array2string(pad_embed, max_line_width=np.inf, separator=' ')[1:-1] + '\n')
-        fout.write(constants.UNK_SYMBOL + ' ' + np.array2string(unk_embed_normalized, max_line_width=np.inf, separator=' ')[1:-1] + '\n')
-        word_to_idx[constants.PAD_SYMBOL] = 0
-        word_to_idx[constants.UNK_SYMBOL] = 1
-
-        for line in fin:
-            word = line.strip()
-            word_embed = wv.word_vec(word)
-            fout.write(word + ' ' + np.array2string(word_embed, max_line_width=np.inf, separator=' ')[1:-1] + '\n')
-            word_to_idx[word] = len(word_to_idx)
+    embed_size = wv.vector_size
+    with open(f'{constants.GENERATED_DIR}/{vocab_filename}', 'r') as fin:
+        vocab = [line.strip() for line in fin]
+
+    words = [constants.PAD_SYMBOL, constants.UNK_SYMBOL] + vocab
+    word_to_idx = {word: idx for idx, word in enumerate(words)}
+    weights = np.empty((len(words), embed_size), dtype=np.float32)
+    weights[0] = 0
+    unk_embed = np.random.randn(embed_size)
+    weights[1] = unk_embed / float(np.linalg.norm(unk_embed) + 1e-6)
+    for idx, word in enumerate(vocab, start=2):
+        weights[idx] = wv[word]
+    data.write_embedding_weights(weights, words)
 
     logging.info(f'Size of training vocabulary (including PAD, UNK): {len(word_to_idx)}')
     return word_to_idx
 
 
-def vectorize_code_desc(word_to_idx, out_filename='code_desc_vectors.csv'):
-    desc_dict = load_code_desc()
+def find_new_words(texts, vocab_filename='vocab.csv'):
+    """
+    :param texts: cleaned texts
+    :return: Returns the tokens of texts that are not in the vocab, tokenized as in build_vocab and sorted
+    """
+    with open(f'{constants.GENERATED_DIR}/{vocab_filename}', 'r') as fin:
+        vocab = set(line.strip() for line in fin)
+    analyzer = CountVectorizer(min_df=1).build_analyzer()
+    new_words = set()
+    for text in texts:
+        new_words.update(token for token in analyzer(text) if token not in vocab)
+    return sorted(new_words)
+
+
+def update_embeddings(texts, new_words, embed_filename='disch_full.w2v', epochs=None):
+    """
+    Continue training the saved Word2Vec model on the new texts only, then append rows for new_words to the
+    embedding matrix. Existing rows and indices are left untouched.
+    :return: Returns the updated Word2Vec model, which the caller saves once the vocab is extended as well
+    """
+    w2v_model = Word2Vec.load(f'{constants.GENERATED_DIR}/{embed_filename}')
+    sentences = [text.split() for text in texts]
+    w2v_model.build_vocab(sentences, update=True)
+    w2v_model.train(sentences, total_examples=len(sentences), epochs=epochs or w2v_model.epochs)
+
+    weights = np.load(constants.EMBED_WEIGHTS_PATH, mmap_mode='r')
+    words = data.load_embedding_vocab()
+    new_weights = np.empty((len(new_words), weights.shape[1]), dtype=np.float32)
+    for idx, word in enumerate(new_words):
+        vector = w2v_model.wv[word]
+        # Rows written by map_vocab_to_embed are unit length (init_sims(replace=True))
+        new_weights[idx] = vector / float(np.linalg.norm(vector) + 1e-6)
+    data.write_embedding_weights(np.concatenate([weights, new_weights]), words + new_words)
+    logging.info(f'Appended {len(new_words)} rows to the {weights.shape} embedding matrix')
+    return w2v_model
+
+
+def update_vocab_and_embeddings(notes_filename, vocab_filename='vocab.csv', embed_filename='disch_full.w2v',
+                                epochs=None, num_workers=None, chunksize=64, cache=None):
+    """
+    Incrementally add newly arriving admissions: clean their notes, extend vocab.csv with unseen tokens, continue
+    Word2Vec training on them and append the new tokens' rows to the embedding matrix. Token ids only ever grow,
+    so models trained on the old vocab still load (see data.load_vocab_indexer(max_size)).
+    The vocab, word2vec and embedding_matrix stages are re-recorded in the stage manifest afterwards, so that
+    a later --build_vocab run keeps the extended files instead of rebuilding them and dropping the new ids.
+    :param notes_filename: CSV of raw notes with a TEXT column, e.g. discharge summaries of the new admissions
+    :param cache: StageCache holding the manifest of the --build_vocab stages, by default the one in GENERATED_DIR
+    :return: Returns the list of appended words
+    """
+    columns = pd.read_csv(notes_filename, nrows=0).columns
+    notes_df = pd.read_csv(notes_filename, usecols=[find_column(columns, ['TEXT'])])
+    texts = list(clean_texts(notes_df.iloc[:, 0].fillna(''), num_workers, chunksize))
+
+    vocab_path = f'{constants.GENERATED_DIR}/{vocab_filename}'
+    with open(vocab_path, 'r') as fin:
+        vocab = [line.strip() for line in fin]
+    if data.load_embedding_vocab() != [constants.PAD_SYMBOL, constants.UNK_SYMBOL] + vocab:
+        raise ValueError(f'{constants.EMBED_VOCAB_PATH} does not match {vocab_path}, rebuild the embeddings first')
+
+    new_words = find_new_words(texts, vocab_filename)
+    w2v_model = update_embeddings(texts, new_words, embed_filename, epochs)
+    # The vocab is extended after the matrix: a crash before this leaves a matrix that load_embedding_weights
+    # rejects, and the model is saved last so that a rerun continues from the old one, not from one already
+    # trained on these notes
+    with open(vocab_path, 'a') as fout:
+        for word in new_words:
+            fout.write(f'{word}\n')
+    w2v_model.save(f'{constants.GENERATED_DIR}/{embed_filename}')
+    cache = cache or StageCache()
+    for name in ['vocab', 'word2vec', 'embedding_matrix']:
+        cache.refresh(name)
+    logging.info(f'Added {len(new_words)} words from {len(texts)} notes, vocab size is now {len(vocab) + len(new_words)}')
+    print(f"\nAdded {len(new_words)} new words from {len(texts)} notes to {vocab_path}")
+    return new_words
+
+
+def vectorize_code_desc(word_to_idx, out_filename='code_desc_vectors.csv', num_workers=None, chunksize=64):
+    desc_dict = load_clean_code_desc(num_workers, chunksize)
     with open(f'{constants.GENERATED_DIR}/{out_filename}', 'w') as fout:
         w = csv.writer(fout, delimiter=' ')
         w.writerow(["CODE", "VECTOR"])
         for code, desc in desc_dict.items():
-            tokens = clean_text(desc, trantab, my_stopwords, stemmer).split()
+            tokens = desc.split()
             inds = [word_to_idx[t] if t in word_to_idx.keys() else word_to_idx[constants.UNK_SYMBOL] for t in tokens]
             w.writerow([code] + [str(i) for i in inds])
 
@@ -475,20 +891,99 @@ def inspect_noteevents():
         print(f"File path: {constants.NOTEEVENTS_FILE_PATH}")
 
 
-def main():
-    """Main preprocessing pipeline"""
-    print("Inspecting NOTEEVENTS structure...")
-    inspect_noteevents()
-    
-    print("\nProcessing discharge summaries...")
-    hadm_id_set, disch_filename = write_discharge_summaries()
-    
-    print("\nProcessing procedures...")
-    proc_by_admission = process_procedures()
-    
-    print("\nCreating dataset splits...")
-    create_datasets(hadm_id_set)
-    
+def main(args):
+    """Main preprocessing pipeline, skipping stages whose outputs are up to date"""
+    if os.path.exists(constants.STEM_CACHE_PATH):
+        stemmer.load(constants.STEM_CACHE_PATH)
+    cache = StageCache(force=args.force_stages)
+    if args.update_vocab:
+        update_vocab_and_embeddings(args.update_vocab, epochs=args.update_epochs, num_workers=args.clean_workers,
+                                    chunksize=args.clean_chunksize, cache=cache)
+        stemmer.save(constants.STEM_CACHE_PATH)
+        return
+    desc_paths = [constants.DIAG_CODE_DESC_FILE_PATH, constants.PROC_CODE_DESC_FILE_PATH, constants.ICD_DESC_FILE_PATH]
+    clean_params = {'stopwords': sorted(my_stopwords), 'punct': punct}
+    clean_kwargs = {'num_workers': args.clean_workers, 'chunksize': args.clean_chunksize}
+    disch_full_path = f'{constants.GENERATED_DIR}/disch_full.csv'
+
+    def extract_discharge_summaries():
+        if not args.notes_chunksize:
+            print("Inspecting NOTEEVENTS structure...")
+            inspect_noteevents()
+        print("\nProcessing discharge summaries...")
+        write_discharge_summaries(args.notes_chunksize)
+    cache.run('discharge_summaries', extract_discharge_summaries, inputs=[get_data_path('MIMIC_NOTES_PATH')],
+              outputs=[DISCH_FILE_PATH, DISCH_HADM_IDS_FILE_PATH], params={'categories': DISCHARGE_CATEGORIES})
+
+    def clean_discharge_summaries():
+        print("\nCleaning discharge summaries...")
+        write_clean_discharge_summaries(DISCH_FILE_PATH, **clean_kwargs)
+    cache.run('clean_text', clean_discharge_summaries, inputs=[DISCH_FILE_PATH], outputs=[disch_full_path],
+              params=clean_params)
+
+    def group_procedures():
+        print("\nProcessing procedures...")
+        process_procedures()
+    cache.run('procedures', group_procedures, inputs=[get_data_path('MIMIC_PROCEDURES_PATH')],
+              outputs=[PROC_BY_ADMISSION_FILE_PATH])
+
+    code_paths = [constants.DIAGNOSES_FILE_PATH, constants.PROCEDURES_FILE_PATH]
+    if all(os.path.exists(path) for path in code_paths):
+        def combine_codes():
+            print("\nCombining diagnosis and procedure codes...")
+            combine_diag_proc_codes(pd.read_csv(DISCH_HADM_IDS_FILE_PATH)['HADM_ID'].tolist())
+        cache.run('codes', combine_codes, inputs=code_paths + [DISCH_HADM_IDS_FILE_PATH],
+                  outputs=[f'{constants.GENERATED_DIR}/ALL_CODES_filtered.csv',
+                           f'{constants.GENERATED_DIR}/ALL_CODES_labels.csv'])
+    else:
+        print(f"\nSkipping code table: {' or '.join(code_paths)} not found")
+
+    def split_admissions():
+        print("\nCreating dataset splits...")
+        create_datasets(pd.read_csv(DISCH_HADM_IDS_FILE_PATH)['HADM_ID'].tolist(), args.split_ratios)
+    cache.run('splits', split_admissions, inputs=[DISCH_HADM_IDS_FILE_PATH], outputs=get_split_hadm_ids_paths(),
+              params={'split_ratios': args.split_ratios})
+
+    split_paths = [f'{constants.GENERATED_DIR}/{split}_{args.data_setting}.csv' for split in constants.SPLITS]
+    train_full_path = f'{constants.GENERATED_DIR}/train_full.csv'
+    if args.build_vocab and os.path.exists(train_full_path):
+        w2v_params = {'embed_size': args.embed_size, 'min_count': 0, 'window': 5, 'num_negatives': 5, 'epochs': 30}
+        w2v_path = f'{constants.GENERATED_DIR}/disch_full.w2v'
+        sentences_path = f'{constants.GENERATED_DIR}/disch_full.sentences'
+
+        def train_embeddings():
+            print("\nTraining word embeddings...")
+            embed_words(**w2v_params, clean_workers=args.clean_workers, clean_chunksize=args.clean_chunksize)
+        cache.run('vocab', lambda: build_vocab(**clean_kwargs), inputs=[train_full_path] + desc_paths,
+                  outputs=[constants.VOCAB_FILE_PATH], params=clean_params)
+        cache.run('sentence_corpus', lambda: write_sentence_corpus(**clean_kwargs),
+                  inputs=[disch_full_path] + desc_paths, outputs=[sentences_path], params=clean_params)
+        cache.run('word2vec', train_embeddings, inputs=[sentences_path], outputs=[w2v_path], params=w2v_params)
+        cache.run('embedding_matrix', lambda: vectorize_code_desc(map_vocab_to_embed(), **clean_kwargs),
+                  inputs=[constants.VOCAB_FILE_PATH, w2v_path] + desc_paths,
+                  outputs=[constants.EMBED_WEIGHTS_PATH, constants.EMBED_VOCAB_PATH, constants.CODE_DESC_VECTOR_PATH],
+                  params=clean_params)
+    elif args.build_vocab:
+        print(f"\nSkipping vocab and embeddings: {train_full_path} not found")
+
+    if os.path.exists(constants.VOCAB_FILE_PATH) and all(os.path.exists(path) for path in split_paths):
+        def index_corpora():
+            print("\nWriting token-ID corpus...")
+            data.write_corpora(args.data_setting)
+        code_freq_paths = [constants.CODE_FREQ_PATH] if args.data_setting == constants.FULL else []
+        corpus_paths = [os.path.join(data.get_corpus_dir(args.data_setting, split), f'{name}.npy')
+                        for split in constants.SPLITS
+                        for name in ['hadm_ids', 'tokens', 'offsets', 'label_ids', 'label_offsets', 'codes']]
+        cache.run('corpus', index_corpora, inputs=[constants.VOCAB_FILE_PATH] + split_paths + code_freq_paths,
+                  outputs=corpus_paths, params={'data_setting': args.data_setting})
+    else:
+        print(f"\nSkipping token-ID corpus: vocab or {args.data_setting} split files not found in {constants.GENERATED_DIR}")
+
+    stemmer.save(constants.STEM_CACHE_PATH)
+    logging.info(f'Stem cache stats: {stemmer.stats()}')
+    print(f"\nStem cache stats: {stemmer.stats()}")
+
+    print(f"\nStage timings:\n{cache.report()}")
     print("\nPreprocessing complete!")
 
 
@@ -498,5 +993,5 @@ if __name__ == "__main__":
     args = constants.get_args()
     FORMAT = '%(asctime)-15s %(message)s'
     logging.basicConfig(filename='../results/preprocess.log', filemode='w', format=FORMAT, level=logging.INFO)
-    main()
+    main(args)
 
@@ -0,0 +1,122 @@
+import os
+import sys
+import json
+import logging
+import numpy as np
+
+RESULT_ARRAYS = ['hadm_ids', 'probabs', 'targets', 'p_at_ks', 'lengths', 'top_codes', 'top_attn']
+
+
+def _save_array(results_dir, name, array):
+    path = os.path.join(results_dir, f'{name}.npy')
+    # evaluate() may already have streamed this array into place as a memmap
+    if isinstance(array, np.memmap) and os.path.exists(path) and os.path.samefile(array.filename, path):
+        array.flush()
+    else:
+        np.save(path, array)
+
+
+def write_results(results_dir, hadm_ids, probabs, targets, codes, ks=None, p_at_ks=None, attention=None):
+    """
+    Save one split's predictions as .npy arrays that ResultsStore can memory-map.
+    :param codes: label names, in column order of probabs/targets
+    :param p_at_ks: optional N x len(ks) per-example precision at ks
+    :param attention: optional dict from trainer.evaluate with top 'codes', 'weights' and document 'lengths'
+    """
+    os.makedirs(results_dir, exist_ok=True)
+    _save_array(results_dir, 'hadm_ids', np.asarray(hadm_ids, dtype=np.int64))
+    _save_array(results_dir, 'probabs', np.asarray(probabs, dtype=np.float32))
+    _save_array(results_dir, 'targets', np.asarray(targets, dtype=np.int8))
+    if p_at_ks is not None:
+        _save_array(results_dir, 'p_at_ks', np.asarray(p_at_ks, dtype=np.float32))
+    if attention is not None:
+        _save_array(results_dir, 'lengths', attention['lengths'])
+        _save_array(results_dir, 'top_codes', attention['codes'])
+        _save_array(results_dir, 'top_attn', attention['weights'])
+    else:
+        # Don't let ResultsStore pick up the attention of an earlier run into the same directory
+        for name in ['lengths', 'top_codes', 'top_attn']:
+            path = os.path.join(results_dir, f'{name}.npy')
+            if os.path.exists(path):
+                os.remove(path)
+    with open(os.path.join(results_dir, 'meta.json'), 'w') as fout:
+        json.dump({'codes': list(codes), 'ks': list(ks) if ks is not None else None}, fout)
+    logging.info(f'Wrote results for {len(hadm_ids)} admissions to {results_dir}')
+
+
+class ResultsStore(object):
+    """
+    Read-only access to a results directory written by write_results. Arrays are memory-mapped and
+    a HADM_ID -> row index is built on open, so looking up one admission is O(1) and only touches its rows.
+
+    Attributes:
+        codes: label names, in column order
+        ks: the k values of the p_at_ks columns
+    """
+    def __init__(self, results_dir):
+        self.results_dir = results_dir
+        with open(os.path.join(results_dir, 'meta.json')) as fin:
+            meta = json.load(fin)
+        self.codes = meta['codes']
+        self.ks = meta['ks']
+        self.arrays = {}
+        for name in RESULT_ARRAYS:
+            path = os.path.join(results_dir, f'{name}.npy')
+            if os.path.exists(path):
+                self.arrays[name] = np.load(path, mmap_mode='r')
+        self.index = {int(hadm_id): row for row, hadm_id in enumerate(self.arrays['hadm_ids'])}
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, hadm_id):
+        return int(hadm_id) in self.index
+
+    def has_attention(self):
+        return 'top_attn' in self.arrays
+
+    def row(self, hadm_id):
+        """
+        :return: Returns the row of hadm_id, raises KeyError if it is not in the store
+        """
+        return self.index[int(hadm_id)]
+
+    def top_predictions(self, hadm_id, k=5):
+        """
+        :return: Returns [(code, probability, is_true_code)] for the k most probable codes
+        """
+        row = self.row(hadm_id)
+        probabs = np.asarray(self.arrays['probabs'][row])
+        targets = self.arrays['targets'][row]
+        top = np.argsort(-probabs, kind='stable')[:k]
+        return [(self.codes[i], float(probabs[i]), bool(targets[i])) for i in top]
+
+    def explanation(self, hadm_id):
+        """
+        :return: Returns a dict with the admission's true codes, its precision at ks and, for each code whose
+                 attention was kept, the probability and the attention weights over the document's tokens
+        """
+        row = self.row(hadm_id)
+        targets = self.arrays['targets'][row]
+        explanation = {'hadm_id': int(hadm_id),
+                       'true_codes': [self.codes[i] for i in np.flatnonzero(targets)]}
+        if 'p_at_ks' in self.arrays:
+            explanation['precision_at_ks'] = dict(zip(self.ks, self.arrays['p_at_ks'][row].tolist()))
+        if self.has_attention():
+            length = int(self.arrays['lengths'][row])
+            probabs = self.arrays['probabs'][row]
+            explanation['predictions'] = [{'code': self.codes[code],
+                                           'probability': float(probabs[code]),
+                                           'is_true_code': bool(targets[code]),
+                                           'attention': self.arrays['top_attn'][row, i, :length].astype(np.float32).tolist()}
+                                          for i, code in enumerate(self.arrays['top_codes'][row])]
+        else:
+            explanation['predictions'] = [{'code': code, 'probability': probability, 'is_true_code': is_true}
+                                          for code, probability, is_true in self.top_predictions(hadm_id)]
+        return explanation
+
+
+if __name__ == "__main__":
+    # python results_store.py ../results/test_results_<hype> <HADM_ID>
+    store = ResultsStore(sys.argv[1])
+    print(json.dumps(store.explanation(sys.argv[2]), indent=2))
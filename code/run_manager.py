@@ -12,6 +12,9 @@ class RunManager:
     def __init__(self):
         self.epoch_count = 0
         self.epoch_loss = 0
+        self.epoch_examples = 0
+        self.epoch_tokens = 0
+        self.epoch_padded_tokens = 0
         # self.epoch_num_correct = 0
         self.epoch_start_time = None
 
@@ -47,6 +50,9 @@ class RunManager:
         self.epoch_start_time = time.time()
         self.epoch_count += 1
         self.epoch_loss = 0
+        self.epoch_examples = 0
+        self.epoch_tokens = 0
+        self.epoch_padded_tokens = 0
         # self.epoch_num_correct = 0
         print(f"Epoch {epoch_no} started ...", end=" ")
 
@@ -68,8 +74,11 @@ class RunManager:
         results["run"] = self.run_count
         results["epoch"] = self.epoch_count
         results["loss"] = loss
+        results["padding_efficiency"] = self.epoch_tokens / max(self.epoch_padded_tokens, 1)
         # results["accuracy"] = accuracy
         results["epoch_duration"] = epoch_duration
+        results["examples_per_sec"] = self.epoch_examples / epoch_duration
+        results["tokens_per_sec"] = self.epoch_tokens / epoch_duration
         results["run duration"] = run_duration
 
         for k, v in self.run_params._asdict().items():
@@ -81,8 +90,26 @@ class RunManager:
         # display(df)
         print("Ended")
 
-    def track_loss(self, loss):
-        self.epoch_loss += loss.item() * self.loader.batch_size
+    def track_loss(self, loss, batch_size):
+        self.epoch_loss += loss.item() * batch_size
+        self.epoch_examples += batch_size
+
+    def track_tokens(self, num_tokens, num_padded_tokens):
+        self.epoch_tokens += num_tokens
+        self.epoch_padded_tokens += num_padded_tokens
+
+    def track_scores(self, dtset, scores):
+        # Evaluation scores go into the results of the last finished epoch
+        for k, v in scores.items():
+            self.run_data[-1][f'{dtset}_{k}'] = v
+
+    def add_run(self, run_data):
+        # Collect the epoch results of a run recorded by another RunManager, e.g. in a sweep worker
+        self.run_count += 1
+        for results in run_data:
+            results = OrderedDict(results)
+            results["run"] = self.run_count
+            self.run_data.append(results)
 
     # def track_num_correct(self, preds, labels):
     #     self.epoch_num_correct += self._get_num_correct(preds, labels)
@@ -0,0 +1,135 @@
+import numpy as np
+from collections import OrderedDict
+from sklearn import metrics
+
+KS = [1, 5, 8, 10, 15]
+
+
+def top_k_predictions(probabs, k):
+    """
+    :param probabs: N x L matrix of predicted probabilities
+    :param k: number of codes to keep per example (capped at L)
+    :return: Returns the N x k indices of the highest-probability codes per example, best first.
+             Only the k selected columns are sorted, the rest is partitioned in linear time.
+    """
+    k = min(k, probabs.shape[1])
+    if k < probabs.shape[1]:
+        top = np.argpartition(-probabs, k - 1, axis=1)[:, :k]
+    else:
+        top = np.tile(np.arange(k), (probabs.shape[0], 1))
+    order = np.argsort(-np.take_along_axis(probabs, top, axis=1), axis=1, kind='stable')
+    return np.take_along_axis(top, order, axis=1)
+
+
+def precision_at_ks(targets, top_preds, ks=KS):
+    """
+    Precision at every k in one pass over the sorted top-max(ks) predictions.
+    :return: Returns (mean P@k for each k, N x len(ks) per-example P@k)
+    """
+    hits = np.take_along_axis(targets, top_preds, axis=1)
+    cum_hits = np.cumsum(hits, axis=1)
+    per_example = np.empty((len(top_preds), len(ks)))
+    for i, k in enumerate(ks):
+        k = min(k, top_preds.shape[1])
+        per_example[:, i] = cum_hits[:, k - 1] / float(k)
+    return per_example.mean(axis=0).tolist(), per_example
+
+
+def compute_metrics(probabs, targets, top_preds=None, ks=KS):
+    """
+    Exact scores over a full split.
+    :param top_preds: optional output of top_k_predictions(probabs, max(ks)) to reuse an existing sort
+    :return: Returns (scores, per-example P@k matrix)
+    """
+    preds = np.rint(probabs)  # (probabs > 0.5)
+    if top_preds is None:
+        top_preds = top_k_predictions(probabs, max(ks))
+    p_at_ks, per_example = precision_at_ks(targets, top_preds, ks)
+
+    scores = OrderedDict()
+    scores['accuracy'] = metrics.accuracy_score(targets, preds)
+    scores['f1_micro'] = metrics.f1_score(targets, preds, average='micro')
+    scores['f1_macro'] = metrics.f1_score(targets, preds, average='macro')
+    scores['auc_micro'] = metrics.roc_auc_score(targets, probabs, average='micro')
+    scores['auc_macro'] = metrics.roc_auc_score(targets, probabs, average='macro')
+    for k, p_at_k in zip(ks, p_at_ks):
+        scores[f'p@{k}'] = p_at_k
+    return scores, per_example
+
+
+class MetricsAccumulator(object):
+    """
+    Streaming version of compute_metrics: update() with one batch at a time, then scores().
+    Memory is O(L) for accuracy/F1/P@k, which are exact, plus O(L x num_bins) for the AUCs.
+    The AUCs are approximated from per-label histograms of the logit, binned over [-logit_range, logit_range].
+
+    Attributes:
+        num_labels
+        ks
+        num_bins
+    """
+    def __init__(self, num_labels, ks=KS, num_bins=512, logit_range=12.0):
+        self.num_labels = num_labels
+        self.ks = ks
+        self.num_bins = num_bins
+        self.logit_range = logit_range
+        self.num_examples = 0
+        self.num_exact = 0
+        self.tp = np.zeros(num_labels, dtype=np.int64)
+        self.fp = np.zeros(num_labels, dtype=np.int64)
+        self.fn = np.zeros(num_labels, dtype=np.int64)
+        self.p_at_k_sums = np.zeros(len(ks))
+        self.pos_hist = np.zeros((num_labels, num_bins), dtype=np.int64)
+        self.neg_hist = np.zeros((num_labels, num_bins), dtype=np.int64)
+
+    def update(self, probabs, targets, top_preds=None):
+        """
+        :param probabs: B x L numpy array of probabilities
+        :param targets: B x L numpy 0/1 array
+        :param top_preds: optional B x max(ks) output of top_k_predictions for this batch
+        """
+        targets = targets.astype(bool)
+        preds = probabs > 0.5
+        self.num_examples += len(probabs)
+        self.num_exact += int((preds == targets).all(axis=1).sum())
+        self.tp += (preds & targets).sum(axis=0)
+        self.fp += (preds & ~targets).sum(axis=0)
+        self.fn += (~preds & targets).sum(axis=0)
+
+        if top_preds is None:
+            top_preds = top_k_predictions(probabs, max(self.ks))
+        _, per_example = precision_at_ks(targets, top_preds, self.ks)
+        self.p_at_k_sums += per_example.sum(axis=0)
+
+        clipped = np.clip(probabs, 1e-7, 1 - 1e-7)
+        logits = np.log(clipped) - np.log1p(-clipped)
+        bins = ((logits + self.logit_range) / (2 * self.logit_range) * self.num_bins).astype(np.int64)
+        bins = np.clip(bins, 0, self.num_bins - 1) + np.arange(self.num_labels) * self.num_bins
+        hist_size = self.num_labels * self.num_bins
+        self.pos_hist += np.bincount(bins[targets], minlength=hist_size).reshape(self.num_labels, self.num_bins)
+        self.neg_hist += np.bincount(bins[~targets], minlength=hist_size).reshape(self.num_labels, self.num_bins)
+
+    @staticmethod
+    def _binned_auc(pos_hist, neg_hist):
+        # P(score_pos > score_neg) + 0.5 * P(same bin), over the last axis
+        neg_below = np.cumsum(neg_hist, axis=-1) - neg_hist
+        num_pos = pos_hist.sum(axis=-1)
+        num_neg = neg_hist.sum(axis=-1)
+        wins = (pos_hist * (neg_below + 0.5 * neg_hist)).sum(axis=-1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where((num_pos > 0) & (num_neg > 0), wins / (num_pos * num_neg), np.nan)
+
+    def scores(self):
+        f1_denom = 2 * self.tp + self.fp + self.fn
+        label_f1 = np.divide(2 * self.tp, f1_denom, out=np.zeros(self.num_labels), where=f1_denom > 0)
+        micro_denom = f1_denom.sum()
+
+        scores = OrderedDict()
+        scores['accuracy'] = self.num_exact / max(self.num_examples, 1)
+        scores['f1_micro'] = 2 * self.tp.sum() / micro_denom if micro_denom else 0.0
+        scores['f1_macro'] = label_f1.mean()
+        scores['auc_micro'] = float(self._binned_auc(self.pos_hist.sum(axis=0), self.neg_hist.sum(axis=0)))
+        scores['auc_macro'] = float(np.nanmean(self._binned_auc(self.pos_hist, self.neg_hist)))
+        for k, p_at_k_sum in zip(self.ks, self.p_at_k_sums):
+            scores[f'p@{k}'] = p_at_k_sum / max(self.num_examples, 1)
+        return scores
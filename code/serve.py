@@ -0,0 +1,264 @@
+import sys
+import json
+import time
+import asyncio
+import logging
+import argparse
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from predict import Predictor, read_notes
+
+REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed', 500: 'Internal Server Error'}
+
+
+class MicroBatcher(object):
+    """
+    Collects single-note requests for up to max_wait_ms (or until max_batch_size are queued) and scores them
+    as one padded batch on a single inference thread, so the event loop keeps accepting requests meanwhile.
+
+    Attributes:
+        latencies: last num_latencies request latencies in seconds, from arrival to result
+        batch_sizes: histogram of batch sizes run through the model
+    """
+    def __init__(self, predictor, max_batch_size=32, max_wait_ms=5, num_latencies=10000):
+        self.predictor = predictor
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.queue = asyncio.Queue()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.latencies = deque(maxlen=num_latencies)
+        self.batch_sizes = Counter()
+        self.num_requests = 0
+        self.start_time = time.time()
+
+    async def predict(self, text, top_k=5):
+        """
+        :return: Returns [(code, probability)] for the top_k codes of one note
+        """
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((text, top_k, future, time.perf_counter()))
+        return await future
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            texts = [text for text, _, _, _ in batch]
+            max_top_k = max(top_k for _, top_k, _, _ in batch)
+            try:
+                predictions = await loop.run_in_executor(self.executor, self.predictor.predict, texts, max_top_k,
+                                                         len(batch))
+            except Exception as e:
+                logging.exception('Batch prediction failed')
+                for _, _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            self.batch_sizes[len(batch)] += 1
+            now = time.perf_counter()
+            for (_, top_k, future, arrival), codes in zip(batch, predictions):
+                self.latencies.append(now - arrival)
+                self.num_requests += 1
+                if not future.done():
+                    future.set_result(codes[:top_k])
+
+    def warm_up(self, num_tokens=512):
+        """Run a full-size batch once so that the first requests don't pay for allocation and lazy init"""
+        vocab_size = len(self.predictor.indexer)
+        words = [self.predictor.indexer.get_object(i) for i in range(2, min(vocab_size, 2 + num_tokens))]
+        start_time = time.time()
+        self.predictor.predict([' '.join(words)] * self.max_batch_size, batch_size=self.max_batch_size)
+        logging.info(f'Warm-up batch of {self.max_batch_size} took {time.time() - start_time:.2f}s')
+
+    def stats(self):
+        latencies_ms = np.array(self.latencies) * 1000
+        stats = {'requests': self.num_requests,
+                 'uptime_sec': time.time() - self.start_time,
+                 'queued': self.queue.qsize(),
+                 'batch_size_histogram': {str(size): count for size, count in sorted(self.batch_sizes.items())}}
+        if len(latencies_ms):
+            stats['latency_ms'] = {f'p{q}': float(np.percentile(latencies_ms, q)) for q in [50, 90, 95, 99]}
+            stats['latency_ms']['mean'] = float(latencies_ms.mean())
+            stats['latency_ms']['max'] = float(latencies_ms.max())
+        return stats
+
+
+async def read_request(reader):
+    """
+    :return: Returns (method, path, headers, body) of one HTTP/1.1 request, or None at end of connection
+    """
+    request_line = await reader.readline()
+    if not request_line:
+        return None
+    method, path, _ = request_line.decode('latin-1').split(' ', 2)
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    body = await reader.readexactly(int(headers.get('content-length', 0)))
+    return method, path, headers, body
+
+
+def write_response(writer, status, payload, keep_alive=True):
+    body = json.dumps(payload).encode('utf-8')
+    writer.write(f'HTTP/1.1 {status} {REASONS[status]}\r\n'
+                 f'Content-Type: application/json\r\n'
+                 f'Content-Length: {len(body)}\r\n'
+                 f'Connection: {"keep-alive" if keep_alive else "close"}\r\n\r\n'.encode('latin-1') + body)
+
+
+async def handle(batcher, method, path, body):
+    """
+    POST /predict {"text": ..., "top_k": 5, "id": ...} -> {"id": ..., "codes": [{"code", "probability"}]}
+    GET /stats -> latency percentiles and batch size histogram, GET /health -> {"status": "ok"}
+    """
+    if path == '/health':
+        return 200, {'status': 'ok'}
+    if path == '/stats':
+        return 200, batcher.stats()
+    if path != '/predict':
+        return 404, {'error': f'unknown path {path}'}
+    if method != 'POST':
+        return 405, {'error': 'use POST'}
+    try:
+        request = json.loads(body)
+        text = request['text']
+        top_k = int(request.get('top_k', 5))
+    except (ValueError, KeyError, TypeError) as e:
+        return 400, {'error': f'expected a JSON object with a "text" field ({e})'}
+    if top_k < 1:
+        return 400, {'error': f'top_k must be at least 1, got {top_k}'}
+    codes = await batcher.predict(text, min(top_k, len(batcher.predictor.labels)))
+    return 200, {'id': request.get('id'),
+                 'codes': [{'code': code, 'probability': probability} for code, probability in codes]}
+
+
+async def serve_connection(batcher, reader, writer):
+    try:
+        while True:
+            request = await read_request(reader)
+            if request is None:
+                break
+            method, path, headers, body = request
+            keep_alive = headers.get('connection', '').lower() != 'close'
+            try:
+                status, payload = await handle(batcher, method, path.split('?')[0], body)
+            except Exception as e:
+                logging.exception(f'{method} {path} failed')
+                status, payload = 500, {'error': str(e)}
+            write_response(writer, status, payload, keep_alive)
+            await writer.drain()
+            if not keep_alive:
+                break
+    except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+        pass
+    finally:
+        writer.close()
+
+
+async def serve(args):
+    predictor = Predictor(args.model_path, num_threads=args.num_threads)
+    batcher = MicroBatcher(predictor, args.max_batch_size, args.max_wait_ms)
+    if args.warm_up:
+        batcher.warm_up()
+    batch_task = asyncio.ensure_future(batcher.run())
+
+    def on_connection(reader, writer):
+        return serve_connection(batcher, reader, writer)
+
+    if args.unix_socket:
+        server = await asyncio.start_unix_server(on_connection, path=args.unix_socket)
+        address = args.unix_socket
+    else:
+        server = await asyncio.start_server(on_connection, args.host, args.port)
+        address = f'http://{args.host}:{args.port}'
+    logging.info(f'Serving {args.model_path} on {address} (max batch {args.max_batch_size}, '
+                 f'max wait {args.max_wait_ms} ms)')
+    print(f'Serving on {address}', file=sys.stderr)
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        batch_task.cancel()
+        logging.info(f'Final stats: {json.dumps(batcher.stats())}')
+
+
+async def load_test(args):
+    """Send every note of args.input as its own /predict request, args.concurrency at a time"""
+    with open(args.input, 'r', newline='') as fin:
+        input_format = 'csv' if args.input.endswith('.csv') else 'jsonl'
+        notes = [text for _, text in read_notes(fin, input_format)]
+    notes = (notes * (args.num_requests // len(notes) + 1))[:args.num_requests]
+    queue = asyncio.Queue()
+    for text in notes:
+        queue.put_nowait(text)
+    latencies = []
+
+    async def client():
+        if args.unix_socket:
+            reader, writer = await asyncio.open_unix_connection(args.unix_socket)
+        else:
+            reader, writer = await asyncio.open_connection(args.host, args.port)
+        while not queue.empty():
+            body = json.dumps({'text': queue.get_nowait()}).encode('utf-8')
+            start_time = time.perf_counter()
+            writer.write(f'POST /predict HTTP/1.1\r\nHost: {args.host}\r\nContent-Type: application/json\r\n'
+                         f'Content-Length: {len(body)}\r\n\r\n'.encode('latin-1') + body)
+            await writer.drain()
+            await read_request(reader)  # status line, headers and body have the same layout as a request
+            latencies.append(time.perf_counter() - start_time)
+        writer.close()
+
+    start_time = time.time()
+    await asyncio.gather(*[client() for _ in range(args.concurrency)])
+    duration = time.time() - start_time
+    latencies_ms = np.array(latencies) * 1000
+    print(f'{len(latencies)} requests with concurrency {args.concurrency}: {len(latencies) / duration:.2f} notes/sec, '
+          + ', '.join(f'p{q} {np.percentile(latencies_ms, q):.1f} ms' for q in [50, 90, 99]))
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='HTTP inference server with dynamic micro-batching')
+    parser.add_argument('--model_path', help='Model saved by main.py, e.g. ../models/TransICD_<hype>.pt')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--unix_socket', default=None, help='Listen on (or connect to) this Unix socket instead')
+    parser.add_argument('--max_batch_size', type=int, default=32, help='Most requests scored in one forward pass')
+    parser.add_argument('--max_wait_ms', type=float, default=5,
+                        help='How long the first queued request waits for others to join its batch')
+    parser.add_argument('--num_threads', type=int, default=None, help='Torch intra-op threads (default: torch default)')
+    parser.add_argument('--no_warm_up', dest='warm_up', action='store_false', help='Skip the warm-up batch')
+    parser.add_argument('--load_test', action='store_true',
+                        help='Act as a client: send the notes in --input to a running server and report latency')
+    parser.add_argument('--input', default=None, help='JSONL or CSV notes for --load_test')
+    parser.add_argument('--num_requests', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--log', default="INFO", help="Logging level.")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = get_args()
+    FORMAT = '%(asctime)-15s %(message)s'
+    logging.basicConfig(format=FORMAT, level=getattr(logging, args.log.upper()), stream=sys.stderr)
+    if args.load_test:
+        asyncio.run(load_test(args))
+    elif not args.model_path:
+        sys.exit('--model_path is required to serve')
+    else:
+        asyncio.run(serve(args))
@@ -0,0 +1,126 @@
+import os
+import json
+import time
+import hashlib
+import logging
+import constants
+
+
+def file_stat(path):
+    stat = os.stat(path)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def hash_file(path, block_size=1 << 20):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as fin:
+        for block in iter(lambda: fin.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class StageCache(object):
+    """
+    Records, for every preprocessing stage, a key made of the content hashes of its input files and its
+    parameters, plus the size/mtime of the outputs it wrote. A stage is skipped when its key is unchanged
+    and its outputs are still on disk untouched. Input hashes are memoized by size/mtime, so an unchanged
+    multi-GB NOTEEVENTS.csv is only stat'ed, not re-read.
+
+    Attributes:
+        manifest: {'stages': {name: {key, inputs, params, outputs}}, 'files': {path: {size, mtime_ns, sha1}}}
+        timings: [(stage name, 'ran' or 'cached', seconds)] in the order the stages were run
+    """
+    def __init__(self, manifest_path=None, force=False):
+        self.manifest_path = manifest_path or constants.STAGE_MANIFEST_PATH
+        self.force = force
+        self.manifest = {'stages': {}, 'files': {}}
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path, 'r') as fin:
+                self.manifest = json.load(fin)
+        self.timings = []
+
+    def file_hash(self, path):
+        path = os.path.abspath(path)
+        stat = file_stat(path)
+        memo = self.manifest['files'].get(path)
+        if memo is None or memo['size'] != stat['size'] or memo['mtime_ns'] != stat['mtime_ns']:
+            memo = dict(stat, sha1=hash_file(path))
+            self.manifest['files'][path] = memo
+        return memo['sha1']
+
+    def stage_key(self, inputs, params):
+        key = {'inputs': {os.path.abspath(path): self.file_hash(path) for path in inputs}, 'params': params}
+        return hashlib.sha1(json.dumps(key, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+    def is_valid(self, name, key, outputs):
+        entry = self.manifest['stages'].get(name)
+        if self.force or entry is None or entry['key'] != key or not outputs:
+            return False
+        for path in outputs:
+            path = os.path.abspath(path)
+            if not os.path.exists(path) or entry['outputs'].get(path) != file_stat(path):
+                return False
+        return True
+
+    def run(self, name, fn, inputs=(), outputs=(), params=None):
+        """
+        Run fn() unless the stage's outputs were produced from the same inputs and params before.
+        :param inputs: files fn reads, fingerprinted by content
+        :param outputs: files fn writes, all of them must exist afterwards
+        :param params: JSON-serializable settings that change fn's outputs
+        :return: Returns True if fn was run, False if the stage was skipped
+        """
+        start_time = time.time()
+        key = self.stage_key(inputs, params)
+        if self.is_valid(name, key, outputs):
+            print(f"\nSkipping {name}: outputs are up to date")
+            self.timings.append((name, 'cached', time.time() - start_time))
+            return False
+
+        fn()
+        self.record(name, key, inputs, params, outputs)
+        self.timings.append((name, 'ran', time.time() - start_time))
+        return True
+
+    def record(self, name, key, inputs, params, outputs):
+        self.manifest['stages'][name] = {'key': key,
+                                         'inputs': [os.path.abspath(path) for path in inputs],
+                                         'params': params,
+                                         'outputs': {os.path.abspath(path): file_stat(path) for path in outputs}}
+        # Later stages may read this stage's outputs, so hash them now while they are in the page cache
+        for path in outputs:
+            self.file_hash(path)
+        self.save()
+
+    def refresh(self, name):
+        """
+        Accept the current outputs of a stage that were rewritten outside of run() on purpose (e.g. by an
+        incremental vocab update), so the next run keeps them instead of rebuilding the stage from scratch.
+        The key is recomputed as well, since the stage's inputs may be other stages' rewritten outputs.
+        :return: Returns True if the stage was re-recorded, False if it was never run or predates recorded inputs
+        """
+        entry = self.manifest['stages'].get(name)
+        if entry is None:
+            return False
+        if 'inputs' not in entry:
+            logging.warning(f'Stage {name} was recorded without its inputs, it will be rerun')
+            return False
+        key = self.stage_key(entry['inputs'], entry['params'])
+        self.record(name, key, entry['inputs'], entry['params'], list(entry['outputs']))
+        return True
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.manifest_path) or '.', exist_ok=True)
+        tmp_path = f'{self.manifest_path}.tmp'
+        with open(tmp_path, 'w') as fout:
+            json.dump(self.manifest, fout, indent=1, sort_keys=True, default=str)
+        os.replace(tmp_path, self.manifest_path)
+
+    def report(self):
+        lines = [f'{"stage":<24}{"status":<8}{"seconds":>10}']
+        for name, status, seconds in self.timings:
+            lines.append(f'{name:<24}{status:<8}{seconds:>10.2f}')
+        lines.append(f'{"total":<32}{sum(seconds for _, _, seconds in self.timings):>10.2f}')
+        report = '\n'.join(lines)
+        logging.info(f'Stage timings:\n{report}')
+        return report
@@ -1,165 +1,411 @@
+import os
+import math
 import torch
 import logging
+import contextlib
+from collections import OrderedDict
 import numpy as np
-from sklearn import metrics
+from scoring import KS, compute_metrics, MetricsAccumulator
 import torch.nn.functional as F
 import torch.optim as optim
 from run_manager import RunManager
 from torch.utils.data import DataLoader
+from data import BucketBatchSampler
+from results_store import write_results
+from checkpoint import get_rng_state, set_rng_state, save_checkpoint, load_checkpoint
 
 
-def train(model, train_set, dev_set, test_set, hyper_params, batch_size, device):
-    train_loader = DataLoader(train_set, batch_size=batch_size, shuffle=True, num_workers=1)
+ATTN_TOP_K = 5
+
+
+def make_loader(dataset, batch_size, shuffle, bucket_batching=False, max_tokens=None):
+    if max_tokens and not bucket_batching:
+        logging.warning(f'max_tokens={max_tokens} only applies with bucket batching, '
+                        f'using batches of {batch_size} examples')
+    if bucket_batching:
+        batch_sampler = BucketBatchSampler(dataset.get_lens(), batch_size, max_tokens=max_tokens, shuffle=shuffle)
+        return DataLoader(dataset, batch_sampler=batch_sampler, num_workers=1, collate_fn=dataset.collate)
+    return DataLoader(dataset, batch_size=batch_size, shuffle=shuffle, num_workers=1, collate_fn=dataset.collate)
+
+
+def resolve_amp_dtype(device, mixed_precision):
+    """
+    Pick the autocast dtype for mixed precision: bfloat16 on CPU and on GPUs that support it.
+    Returns None (plain fp32) when mixed precision is off or unsupported on this device.
+    """
+    if not mixed_precision:
+        return None
+    if device.type == 'cuda' and not torch.cuda.is_bf16_supported():
+        logging.warning(f'bfloat16 is not supported on {device}, falling back to fp32')
+        return None
+    try:
+        with torch.autocast(device_type=device.type, dtype=torch.bfloat16):
+            torch.ones(2, 2, device=device) @ torch.ones(2, 2, device=device)
+    except (RuntimeError, AssertionError) as e:
+        logging.warning(f'bfloat16 autocast failed on {device} ({e}), falling back to fp32')
+        return None
+    return torch.bfloat16
+
+
+def autocast(device, amp_dtype):
+    if amp_dtype is None:
+        return contextlib.nullcontext()
+    return torch.autocast(device_type=device.type, dtype=amp_dtype)
+
+
+def get_run_name(hyper_params, skip=()):
+    return '_'.join([f'{k}_{v}' for k, v in hyper_params._asdict().items() if k not in skip])
+
+
+def train_epoch(model, loader, optimizer, device, m, amp_dtype=None, on_step=None, accumulation_steps=1):
+    """
+    Gradients are accumulated over accumulation_steps batches per optimizer step. The loss is summed and the
+    accumulated gradients are divided by the number of examples in the window, so every example has the same
+    weight however the data is split into batches, including a smaller last batch or window.
+    :param on_step: optional callable run after every optimizer step, the epoch ends early if it returns True
+    """
+    model.train()
+    optimizer.zero_grad()
+    window_examples = 0
+    num_batches = 0
+    for batch in loader:
+        texts = batch['text']
+        lens = batch['length']
+        targets = batch['codes']
+
+        texts = texts.to(device)
+        targets = targets.to(device)
+        with autocast(device, amp_dtype):
+            outputs, ldam_outputs, _ = model(texts, targets)
+
+        # The loss is always computed in fp32, autocast only covers the forward pass.
+        # Summed over examples and averaged over labels, i.e. batch size x the usual mean loss
+        logits = ldam_outputs if ldam_outputs is not None else outputs
+        loss = F.binary_cross_entropy_with_logits(logits.float(), targets, reduction='sum') / targets.size(1)
+        loss.backward()
+        window_examples += len(targets)
+        num_batches += 1
+
+        m.track_loss(loss / len(targets), len(targets))
+        m.track_tokens(lens.sum().item(), texts.numel())
+        # m.track_num_correct(preds, affinities)
+        if num_batches % accumulation_steps == 0:
+            optimizer_step(optimizer, window_examples)
+            window_examples = 0
+            if on_step is not None and on_step():
+                break
+    if window_examples:
+        optimizer_step(optimizer, window_examples)
+        if on_step is not None:
+            on_step()
+
+
+def optimizer_step(optimizer, window_examples):
+    # Turn the summed gradients of the window into the mean over its examples
+    for group in optimizer.param_groups:
+        for param in group['params']:
+            if param.grad is not None:
+                param.grad.div_(window_examples)
+    optimizer.step()
+    optimizer.zero_grad()
+
+
+class EarlyStopping(object):
+    """
+    Keeps the best weights seen so far by a dev metric (higher is better) and signals a stop once the metric
+    has not improved for patience consecutive evaluations.
+
+    Attributes:
+        metric: key of MetricsAccumulator.scores(), e.g. f1_micro or p@5
+        best_score, best_epoch, best_step: when the best weights were seen
+        stopped_epoch: epoch training stopped in, None while training goes on
+    """
+    def __init__(self, metric, patience=5, min_delta=0.0):
+        self.metric = metric
+        self.patience = patience
+        self.min_delta = min_delta
+        self.best_score = None
+        self.best_epoch = None
+        self.best_step = None
+        self.best_state = None
+        self.num_bad_evals = 0
+        self.stopped_epoch = None
+
+    def update(self, model, scores, epoch, step):
+        """
+        :return: Returns True if training should stop
+        """
+        score = scores[self.metric]
+        logging.info(f'Epoch {epoch} step {step}: dev {self.metric} {score} (best {self.best_score})')
+        if self.best_score is None or score > self.best_score + self.min_delta:
+            self.best_score = score
+            self.best_epoch = epoch
+            self.best_step = step
+            self.best_state = {k: v.detach().clone() for k, v in model.state_dict().items()}
+            self.num_bad_evals = 0
+        else:
+            self.num_bad_evals += 1
+        if self.num_bad_evals >= self.patience:
+            self.stopped_epoch = epoch
+        return self.stopped_epoch is not None
+
+    def restore(self, model):
+        if self.best_state is not None:
+            model.load_state_dict(self.best_state)
+
+    def summary(self):
+        return OrderedDict([('metric', self.metric), ('best_score', self.best_score), ('best_epoch', self.best_epoch),
+                            ('best_step', self.best_step), ('stopped_epoch', self.stopped_epoch)])
+
+    def state_dict(self):
+        return {k: getattr(self, k) for k in ['best_score', 'best_epoch', 'best_step', 'best_state', 'num_bad_evals',
+                                              'stopped_epoch']}
+
+    def load_state_dict(self, state):
+        self.__dict__.update(state)
+
+
+def monitor_scores(model, loader, device, amp_dtype=None):
+    """Streaming dev scores for early stopping, one pass without N x L buffers"""
+    was_training = model.training
+    model.eval()
+    accumulator = MetricsAccumulator(loader.dataset.get_code_count())
+    with torch.no_grad():
+        for batch in loader:
+            with autocast(device, amp_dtype):
+                outputs, _, _ = model(batch['text'].to(device))
+            accumulator.update(torch.sigmoid(outputs.float()).cpu().numpy(), batch['codes'].numpy())
+    model.train(was_training)
+    return accumulator.scores()
+
+
+def train(model, train_set, dev_set, test_set, hyper_params, batch_size, device, bucket_batching=False,
+          max_tokens=None, mixed_precision=False, eval_epochs=None, checkpoint_path=None, checkpoint_every=1,
+          resume=False, on_snapshot=None, early_stopping_metric=None, patience=5, monitor_steps=0,
+          accumulation_steps=1, checkpoint_config=None):
+    """
+    Train for hyper_params.num_epoch epochs. The model is evaluated after every epoch count in eval_epochs
+    (by default only the last one), so a grid of epoch counts is covered by a single training run.
+    :param checkpoint_path: if given, a checkpoint is saved there every checkpoint_every epochs and after the last one
+    :param resume: continue from checkpoint_path if it exists, training on up to hyper_params.num_epoch
+    :param checkpoint_config: training configuration saved with each checkpoint, resuming from a checkpoint saved
+           with a different one raises ValueError
+    :param on_snapshot: called as on_snapshot(run_name) after each evaluation, e.g. to save the model
+    :param early_stopping_metric: if given, this dev metric is monitored after every epoch (or every monitor_steps
+           optimizer steps) and training stops once it has not improved for patience evaluations. The best weights
+           are then restored and evaluated as a final snapshot named get_run_name(hyper_params) + '_best', with
+           their scores recorded as best_dev_* / best_test_* so that they never overwrite the scores of the epoch
+           training stopped at.
+    :param accumulation_steps: batches per optimizer step, for an effective batch of batch_size x accumulation_steps
+    :return: Returns the RunManager's per-epoch results, with dev and test scores at the evaluated epochs
+    """
+    eval_epochs = sorted(set(eval_epochs or [hyper_params.num_epoch]))
+    train_loader = make_loader(train_set, batch_size, shuffle=True, bucket_batching=bucket_batching,
+                               max_tokens=max_tokens)
     m = RunManager()
     optimizer = optim.AdamW(model.parameters(), lr=hyper_params.learning_rate)
+    amp_dtype = resolve_amp_dtype(device, mixed_precision)
+    early_stopping = EarlyStopping(early_stopping_metric, patience) if early_stopping_metric else None
+    monitor_loader = make_loader(dev_set, batch_size, shuffle=False, bucket_batching=bucket_batching,
+                                 max_tokens=max_tokens) if early_stopping else None
 
-    logging.info("Training Started...")
-    m.begin_run(hyper_params, model, train_loader)
-    for epoch in range(hyper_params.num_epoch):
-        m.begin_epoch(epoch + 1)
-        model.train()
-        for batch in train_loader:
-            texts = batch['text']
-            lens = batch['length']
-            targets = batch['codes']
+    def snapshot(snapshot_params, prefix='', run_name=None):
+        run_name = run_name or get_run_name(snapshot_params)
+        # Evaluation must not change the random stream of the remaining epochs
+        rng_state = get_rng_state()
+        scores = evaluate_splits(model, train_set, dev_set, test_set, snapshot_params, batch_size, device,
+                                 bucket_batching, max_tokens, amp_dtype, run_name)
+        set_rng_state(rng_state)
+        m.track_scores(f'{prefix}dev', scores['dev'])
+        m.track_scores(f'{prefix}test', scores['test'])
+        m.save(f'../results/train_results_{run_name}')
+        if on_snapshot is not None:
+            on_snapshot(run_name)
 
-            texts = texts.to(device)
-            targets = targets.to(device)
-            outputs, ldam_outputs, _ = model(texts, targets)
+    def monitor(epoch, step):
+        rng_state = get_rng_state()
+        scores = monitor_scores(model, monitor_loader, device, amp_dtype)
+        set_rng_state(rng_state)
+        return early_stopping.update(model, scores, epoch, step)
 
-            if ldam_outputs is not None:
-                loss = F.binary_cross_entropy_with_logits(ldam_outputs, targets)
-            else:
-                loss = F.binary_cross_entropy_with_logits(outputs, targets)
+    m.begin_run(hyper_params, model, train_loader)
+    start_epoch = 0
+    step = 0
+    if resume and checkpoint_path and os.path.exists(checkpoint_path):
+        start_epoch, m.run_data, step = load_checkpoint(checkpoint_path, model, optimizer, early_stopping,
+                                                        checkpoint_config)
+        m.epoch_count = start_epoch
+        if step is None:
+            # Older checkpoints did not record it, so estimate it from the batches of the coming epoch
+            step = start_epoch * math.ceil(len(train_loader) / accumulation_steps)
 
-            optimizer.zero_grad()
-            loss.backward()
-            optimizer.step()
+    logging.info(f"Training Started at epoch {start_epoch + 1} (autocast dtype: {amp_dtype})...")
+    for epoch in range(start_epoch, hyper_params.num_epoch):
+        if early_stopping and early_stopping.stopped_epoch is not None:
+            break
 
-            m.track_loss(loss)
-            # m.track_num_correct(preds, affinities)
+        def on_step():
+            nonlocal step
+            step += 1
+            return bool(early_stopping and monitor_steps and step % monitor_steps == 0 and monitor(epoch + 1, step))
 
+        if hasattr(train_loader.batch_sampler, 'set_epoch'):
+            train_loader.batch_sampler.set_epoch(epoch)
+        m.begin_epoch(epoch + 1)
+        train_epoch(model, train_loader, optimizer, device, m, amp_dtype, on_step, accumulation_steps)
         m.end_epoch()
+        if early_stopping and not monitor_steps:
+            monitor(epoch + 1, step)
+
+        if epoch + 1 in eval_epochs:
+            snapshot(hyper_params._replace(num_epoch=epoch + 1))
+
+        stopped = early_stopping is not None and early_stopping.stopped_epoch is not None
+        if checkpoint_path and checkpoint_every and \
+                ((epoch + 1) % checkpoint_every == 0 or epoch + 1 == hyper_params.num_epoch or stopped):
+            save_checkpoint(checkpoint_path, model, optimizer, epoch + 1, m.run_data, early_stopping, step,
+                            checkpoint_config)
+
+    if early_stopping:
+        if early_stopping.stopped_epoch is not None:
+            logging.info(f'Early stopping at epoch {early_stopping.stopped_epoch}, no {early_stopping.metric} '
+                         f'improvement in {patience} evaluations')
+        logging.info(f'Restoring best weights from epoch {early_stopping.best_epoch} step {early_stopping.best_step} '
+                     f'(dev {early_stopping.metric} {early_stopping.best_score})')
+        early_stopping.restore(model)
+        m.track_scores('early_stopping', early_stopping.summary())
+        # The last row keeps the scores of its own epoch, the best weights' scores get their own columns, and
+        # their artifacts their own name, so num_epoch_N files always hold the weights of epoch N
+        snapshot(hyper_params, prefix='best_', run_name=f'{get_run_name(hyper_params)}_best')
     m.end_run()
-    hype = '_'.join([f'{k}_{v}' for k, v in hyper_params._asdict().items()])
-    m.save(f'../results/train_results_{hype}')
     logging.info("Training finished.\n")
+    return m.run_data
+
+
+def evaluate_splits(model, train_set, dev_set, test_set, hyper_params, batch_size, device, bucket_batching=False,
+                    max_tokens=None, amp_dtype=None, run_name=None):
+    """
+    :param run_name: names the test results directory, by default get_run_name(hyper_params)
+    :return: Returns the scores of each split, keyed by 'train', 'dev' and 'test'
+    """
+    hype = run_name or get_run_name(hyper_params)
+    scores = OrderedDict()
+    logging.info(f"Evaluating {hype}")
 
     # Training
-    train_loader = DataLoader(train_set, batch_size=batch_size, shuffle=True, num_workers=1)
-    probabs, targets, _, _ = evaluate(model, train_loader, device, dtset='train')
-    compute_scores(probabs, targets, hyper_params, dtset='train')
+    train_loader = make_loader(train_set, batch_size, shuffle=False, bucket_batching=bucket_batching,
+                               max_tokens=max_tokens)
+    probabs, targets, _, _ = evaluate(model, train_loader, device, dtset='train', amp_dtype=amp_dtype)
+    scores['train'] = compute_scores(probabs, targets, hyper_params, dtset='train')
 
     # Validation
-    dev_loader = DataLoader(dev_set, batch_size=batch_size, shuffle=True, num_workers=1)
-    probabs, targets, _, _ = evaluate(model, dev_loader, device, dtset='dev')
-    compute_scores(probabs, targets, hyper_params, dtset='dev')
+    dev_loader = make_loader(dev_set, batch_size, shuffle=False, bucket_batching=bucket_batching,
+                              max_tokens=max_tokens)
+    probabs, targets, _, _ = evaluate(model, dev_loader, device, dtset='dev', amp_dtype=amp_dtype)
+    scores['dev'] = compute_scores(probabs, targets, hyper_params, dtset='dev')
 
     # test_dataset
-    test_loader = DataLoader(test_set, batch_size=batch_size, shuffle=True, num_workers=1)
-    probabs, targets, full_hadm_ids, full_attn_weights = evaluate(model, test_loader, device, dtset='test')
-    compute_scores(probabs, targets, hyper_params, dtset='test', full_hadm_ids=full_hadm_ids, full_attn_weights=full_attn_weights)
+    test_loader = make_loader(test_set, batch_size, shuffle=False, bucket_batching=bucket_batching,
+                              max_tokens=max_tokens)
+    results_dir = f'../results/test_results_{hype}'
+    os.makedirs(results_dir, exist_ok=True)
+    probabs, targets, hadm_ids, attention = evaluate(model, test_loader, device, dtset='test', amp_dtype=amp_dtype,
+                                                     attn_path=os.path.join(results_dir, 'top_attn.npy'))
+    scores['test'] = compute_scores(probabs, targets, hyper_params, dtset='test', hadm_ids=hadm_ids,
+                                    attention=attention, codes=test_set.codes, results_dir=results_dir)
+    return scores
 
 
-def evaluate(model, loader, device, dtset):
-    fin_targets = []
-    fin_probabs = []
-    full_hadm_ids = []
-    full_attn_weights = []
+def evaluate(model, loader, device, dtset, amp_dtype=None, attn_top_k=ATTN_TOP_K, attn_path=None):
+    """
+    Run the model over a loader, writing into preallocated numpy buffers rather than Python lists.
+    For the test set, attention weights are kept only for each example's attn_top_k highest-scoring codes,
+    in an N x attn_top_k x S float16 buffer, S the longest document, that is memory-mapped to attn_path when given.
+    :return: Returns (probabs N x L, targets N x L, hadm_ids N, attention) where attention is None or a dict of
+             'codes' N x attn_top_k, 'weights' N x attn_top_k x S and document 'lengths' N
+    """
+    dataset = loader.dataset
+    num_examples = len(dataset)
+    fin_probabs = np.empty((num_examples, dataset.get_code_count()), dtype=np.float32)
+    fin_targets = np.empty((num_examples, dataset.get_code_count()), dtype=np.int8)
+    fin_hadm_ids = np.empty(num_examples, dtype=np.int64)
+    fin_lengths = np.empty(num_examples, dtype=np.int32)
+    top_codes = None
+    top_attn_weights = None
 
     with torch.no_grad():
         # Set the model to evaluation mode
         model.eval()
+        start = 0
         for batch in loader:
-            hadm_ids = batch['hadm_id']
             texts = batch['text']
-            lens = batch['length']
             targets = batch['codes']
+            end = start + len(targets)
 
             texts = texts.to(device)
-            targets = targets
-            outputs, _, attn_weights = model(texts)
-
-            fin_targets.extend(targets.tolist())
-            fin_probabs.extend(torch.sigmoid(outputs).detach().cpu().tolist())
-            if dtset == 'test' and attn_weights is not None:
-                full_hadm_ids.extend(hadm_ids)
-                full_attn_weights.extend(attn_weights.detach().cpu().tolist())
-    return fin_probabs, fin_targets, full_hadm_ids, full_attn_weights
-
-
-def save_predictions(probabs, targets, dtset, hype):
-    np.savetxt(f'../results/{dtset}_probabs_{hype}.txt', probabs)
-    np.savetxt(f'../results/{dtset}_targets_{hype}.txt', targets)
-
-
-def precision_at_k(true_labels, pred_probs):
-    # num true labels in top k predictions / k
-    ks = [1, 5, 8, 10, 15]
-    sorted_pred = np.argsort(pred_probs)[:, ::-1]
-    output = []
-    p5_scores = None
-    for k in ks:
-        topk = sorted_pred[:, :k]
-
-        # get precision at k for each example
-        vals = []
-        for i, tk in enumerate(topk):
-            if len(tk) > 0:
-                num_true_in_top_k = true_labels[i, tk].sum()
-                denom = len(tk)
-                vals.append(num_true_in_top_k / float(denom))
-
-        output.append(np.mean(vals))
-        if k == 5:
-            p5_scores = np.array(vals)
-    return output, p5_scores
-
-
-def compute_scores(probabs, targets, hyper_params, dtset, full_hadm_ids=None, full_attn_weights=None):
-    probabs = np.array(probabs)
-    targets = np.array(targets)
-
-    preds = np.rint(probabs)  # (probabs >= 0.5)
-    accuracy = metrics.accuracy_score(targets, preds)
-    f1_score_micro = metrics.f1_score(targets, preds, average='micro')
-    f1_score_macro = metrics.f1_score(targets, preds, average='macro')
-    auc_score_micro = metrics.roc_auc_score(targets, probabs, average='micro')
-    auc_score_macro = metrics.roc_auc_score(targets, probabs, average='macro')
-    precision_at_ks, p5_scores = precision_at_k(targets, probabs)
-
-    logging.info(f"{dtset} Accuracy: {accuracy}")
-    logging.info(f"{dtset} f1 score (micro): {f1_score_micro}")
-    logging.info(f"{dtset} f1 score (macro): {f1_score_macro}")
-    logging.info(f"{dtset} auc score (micro): {auc_score_micro}")
-    logging.info(f"{dtset} auc score (macro): {auc_score_macro}")
-    logging.info(f"{dtset} precision at ks [1, 5, 8, 10, 15]: {precision_at_ks}\n")
-
-    print(f"\n{dtset} accuracy: {accuracy}"
-          f"\n{dtset} f1 score (micro): {f1_score_micro}"
-          f"\n{dtset} f1 score (macro): {f1_score_macro}"
-          f"\n{dtset} auc score (micro): {auc_score_micro}"
-          f"\n{dtset} auc score (macro): {auc_score_macro}"
-          f"\n{dtset} precision at ks [1, 5, 8, 10, 15]: {precision_at_ks}")
-
-    if dtset == 'test' and full_attn_weights:
-        hype = '_'.join([f'{k}_{v}' for k, v in hyper_params._asdict().items()])
-        save_predictions(probabs, targets, dtset, hype)
-        # print(len(p5_scores), len(targets), len(full_hadm_ids), len(full_attn_weights))
-        full_attn_weights = np.array(full_attn_weights)
-        sorted_idx = np.argsort(p5_scores)[::-1]
-        sorted_pred = np.argsort(probabs)[:, ::-1]
-        top5_preds = sorted_pred[:, :5]
-        with open(f'../results/{dtset}_attn_weights_{hype}.txt', 'w') as fout:
-            for idx in sorted_idx:
-                fout.write(f'idx: {idx}\n')
-                fout.write(f'{full_hadm_ids[idx]};{p5_scores[idx]}\n')
-                fout.write(f'{sorted_pred[idx]}\n')
-                fout.write(f'{targets[idx, sorted_pred[idx]]}\n')
-                fout.write(f'{preds[idx, sorted_pred[idx]]}\n')
-                fout.write(f'{probabs[idx, sorted_pred[idx]]}\n')
-                weights = full_attn_weights[idx, top5_preds[idx]]
-                for wlist in weights:
-                    line = ' '.join([str(val) for val in wlist])
-                    fout.write(line+'\n')
+            keep_attn = dtset == 'test'
+            with autocast(device, amp_dtype):
+                # For the test set, the model returns attention weights of the top attn_top_k codes only
+                outputs, _, attn_weights = model(texts, attn_top_k=attn_top_k if keep_attn else None)
+            outputs = outputs.float()
+
+            fin_targets[start:end] = targets.numpy()
+            fin_probabs[start:end] = torch.sigmoid(outputs).cpu().numpy()
+            fin_hadm_ids[start:end] = batch['hadm_id'].numpy()
+            fin_lengths[start:end] = batch['length'].numpy()
+            if keep_attn and attn_weights is not None:
+                k = attn_weights.size(1)
+                if top_attn_weights is None:
+                    top_codes = np.empty((num_examples, k), dtype=np.int64)
+                    seq_len = max(int(dataset.get_lens().max()), 1)
+                    shape = (num_examples, k, seq_len)
+                    if attn_path:
+                        top_attn_weights = np.lib.format.open_memmap(attn_path, mode='w+', dtype=np.float16,
+                                                                     shape=shape)
+                    else:
+                        top_attn_weights = np.zeros(shape, dtype=np.float16)
+                # attn_weights: B x k x S, the same codes as outputs.topk
+                top_codes[start:end] = outputs.topk(k, dim=1).indices.cpu().numpy()
+                # Batches may be padded to different lengths (beyond S in chunked mode), weights on padding are zero
+                batch_attn = attn_weights[:, :, :seq_len]
+                top_attn_weights[start:end, :, :batch_attn.size(2)] = batch_attn.float().cpu().numpy()
+            start = end
+
+    attention = None
+    if top_attn_weights is not None:
+        attention = {'codes': top_codes, 'weights': top_attn_weights, 'lengths': fin_lengths}
+    return fin_probabs, fin_targets, fin_hadm_ids, attention
+
+
+def report_scores(scores, dtset):
+    precision_at_ks = [v for k, v in scores.items() if k.startswith('p@')]
+    logging.info(f"{dtset} Accuracy: {scores['accuracy']}")
+    logging.info(f"{dtset} f1 score (micro): {scores['f1_micro']}")
+    logging.info(f"{dtset} f1 score (macro): {scores['f1_macro']}")
+    logging.info(f"{dtset} auc score (micro): {scores['auc_micro']}")
+    logging.info(f"{dtset} auc score (macro): {scores['auc_macro']}")
+    logging.info(f"{dtset} precision at ks {KS}: {precision_at_ks}\n")
+
+    print(f"\n{dtset} accuracy: {scores['accuracy']}"
+          f"\n{dtset} f1 score (micro): {scores['f1_micro']}"
+          f"\n{dtset} f1 score (macro): {scores['f1_macro']}"
+          f"\n{dtset} auc score (micro): {scores['auc_micro']}"
+          f"\n{dtset} auc score (macro): {scores['auc_macro']}"
+          f"\n{dtset} precision at ks {KS}: {precision_at_ks}")
+
+
+def compute_scores(probabs, targets, hyper_params, dtset, hadm_ids=None, attention=None, codes=None,
+                   results_dir=None):
+    """
+    Score a split. For the test split, predictions, targets, per-example precision at ks and, for models that
+    have it, the top-k attention are also written as a binary store under results_dir, see
+    results_store.ResultsStore for reading them back.
+    """
+    scores, p_at_k_scores = compute_metrics(probabs, targets)
+    report_scores(scores, dtset)
+
+    if dtset == 'test' and results_dir is not None:
+        write_results(results_dir, hadm_ids, probabs, targets, codes, ks=KS, p_at_ks=p_at_k_scores,
+                      attention=attention)
 
+    return scores
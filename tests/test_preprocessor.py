@@ -0,0 +1,79 @@
+import os
+import sys
+import random
+import pandas as pd
+import pytest
+import constants
+import data
+import preprocessor
+
+WORDS = 'fever cough chest pain admitted stable discharged ward given antibiotics tablets'.split()
+
+
+@pytest.fixture
+def mimic_dir(tmp_path, monkeypatch):
+    """A tiny MIMIC-like tree with every generated path of constants, data and preprocessor under tmp_path"""
+    rng = random.Random(0)
+    generated_dir = tmp_path / 'generated'
+    os.makedirs(tmp_path / 'mimicdata' / 'processed')
+    os.makedirs(generated_dir)
+    notes = [(i, 1000 + i, '2100-01-01', 'Discharge summary', ' '.join(rng.choice(WORDS) for _ in range(30)))
+             for i in range(40)]
+    pd.DataFrame(notes, columns=['SUBJECT_ID', 'HADM_ID', 'CHARTDATE', 'CATEGORY', 'TEXT']).to_csv(
+        tmp_path / 'NOTEEVENTS.csv', index=False)
+    pd.DataFrame([(1, 0, 1000, 1, '3605')], columns=['ROW_ID', 'SUBJECT_ID', 'HADM_ID', 'SEQ_NUM', 'ICD9_CODE']).to_csv(
+        tmp_path / 'PROCEDURES_ICD.csv', index=False)
+    pd.DataFrame([(1, '4019', 'Hypertension', 'Unspecified essential hypertension')],
+                 columns=['row_id', 'icd9_code', 'short_title', 'long_title']).to_csv(
+        tmp_path / 'D_ICD_DIAGNOSES.csv', index=False)
+    pd.DataFrame([(1, '3605', 'PTCA', 'Percutaneous transluminal coronary angioplasty')],
+                 columns=['row_id', 'icd9_code', 'short_title', 'long_title']).to_csv(
+        tmp_path / 'D_ICD_PROCEDURES.csv', index=False)
+    (tmp_path / 'ICD9_descriptions').write_text('401\tEssential hypertension\n')
+    train_texts = [preprocessor.clean_text(text, preprocessor.trantab, preprocessor.my_stopwords,
+                                           preprocessor.stemmer) for *_, text in notes]
+    pd.DataFrame({'SUBJECT_ID': range(40), 'HADM_ID': range(1000, 1040), 'TEXT': train_texts}).to_csv(
+        generated_dir / 'train_full.csv', index=False)
+
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv('MIMIC_NOTES_PATH', str(tmp_path / 'NOTEEVENTS.csv'))
+    monkeypatch.setenv('MIMIC_PROCEDURES_PATH', str(tmp_path / 'PROCEDURES_ICD.csv'))
+    paths = {'GENERATED_DIR': str(generated_dir),
+             'VOCAB_FILE_PATH': str(generated_dir / 'vocab.csv'),
+             'EMBED_WEIGHTS_PATH': str(generated_dir / 'vocab_embed.npy'),
+             'EMBED_VOCAB_PATH': str(generated_dir / 'vocab_embed.vocab'),
+             'CODE_DESC_VECTOR_PATH': str(generated_dir / 'code_desc_vectors.csv'),
+             'STEM_CACHE_PATH': str(generated_dir / 'stem_cache.csv'),
+             'STAGE_MANIFEST_PATH': str(generated_dir / 'stage_manifest.json'),
+             'CORPUS_DIR': str(generated_dir / 'corpus'),
+             'DIAG_CODE_DESC_FILE_PATH': str(tmp_path / 'D_ICD_DIAGNOSES.csv'),
+             'PROC_CODE_DESC_FILE_PATH': str(tmp_path / 'D_ICD_PROCEDURES.csv'),
+             'ICD_DESC_FILE_PATH': str(tmp_path / 'ICD9_descriptions'),
+             'DIAGNOSES_FILE_PATH': str(tmp_path / 'missing.csv'),
+             'PROCEDURES_FILE_PATH': str(tmp_path / 'missing.csv')}
+    for name, path in paths.items():
+        monkeypatch.setattr(constants, name, path)
+        if hasattr(data, name):
+            monkeypatch.setattr(data, name, path)
+    monkeypatch.setattr(preprocessor, '_clean_code_desc', {})
+    return tmp_path
+
+
+def run_preprocessor(monkeypatch, *argv):
+    monkeypatch.setattr(sys, 'argv', ['preprocessor.py', '--clean_workers', '1', '--embed_size', '8'] + list(argv))
+    preprocessor.main(constants.get_args())
+
+
+def test_build_vocab_keeps_incremental_update(mimic_dir, monkeypatch):
+    run_preprocessor(monkeypatch, '--build_vocab')
+    pd.DataFrame({'TEXT': ['Zzznewword qqqnovel fever cough']}).to_csv(mimic_dir / 'new_notes.csv', index=False)
+    run_preprocessor(monkeypatch, '--update_vocab', str(mimic_dir / 'new_notes.csv'))
+
+    vocab = (mimic_dir / 'generated' / 'vocab.csv').read_text()
+    assert vocab.split()[-2:] == ['qqqnovel', 'zzznewword']
+    weights_stat = os.stat(constants.EMBED_WEIGHTS_PATH)
+
+    run_preprocessor(monkeypatch, '--build_vocab', '--split_ratios', '0.6', '0.2', '0.2')
+    assert (mimic_dir / 'generated' / 'vocab.csv').read_text() == vocab
+    assert os.stat(constants.EMBED_WEIGHTS_PATH).st_mtime_ns == weights_stat.st_mtime_ns
+    assert len(data.load_embedding_vocab()) == len(vocab.split()) + 2